@@ -4,6 +4,7 @@ import pandas as pd
 import numpy as np
 # from keras.models import clone_model
 from sklearn.linear_model import LogisticRegression
+from sklearn.base import clone
 from statsmodels.tsa.statespace.dynamic_factor_mq import DynamicFactorMQ
 from statsmodels.tsa.statespace.exponential_smoothing import ExponentialSmoothing
 from statsmodels.tsa.statespace.sarimax import SARIMAX
@@ -37,93 +38,83 @@ class prediction_interval():
         self.WeightCP_online_resid = np.array([])
         self.JaB_boot_samples_idx = 0
         self.JaB_boot_predictions = 0
+        # If the regressor is a forest, fit ONE bagged forest with B trees and use its trees as the bootstrap models
+        self.use_forest_OOB = False
+        # Past windows at least this long slide a SortedWindow instead of re-partitioning each window
+        self.sorted_window_min = 2000
 
-    def fit_bootstrap_models_online(self, B, miss_test_idx):
+    def fit_bootstrap_models_online(self, B, miss_test_idx, seed=None):
         '''
           Train B bootstrap estimators from subsets of (X_train, Y_train), compute aggregated predictors, and compute the residuals
+          seed: None uses the global np.random state; otherwise each f^b draws its sample from its own child stream of `seed`
         '''
         n = len(self.X_train)
         n1 = len(self.X_predict)
         # hold indices of training data for each f^b
-        boot_samples_idx = util.generate_bootstrap_samples(n, n, B)
+        boot_samples_idx = util.generate_bootstrap_samples(n, n, B, seed=seed)
         # hold predictions from each f^b
         boot_predictions = np.zeros((B, (n+n1)), dtype=float)
         # for i^th column, it shows which f^b uses i in training (so exclude in aggregation)
         in_boot_sample = np.zeros((B, n), dtype=bool)
-        out_sample_predict = np.zeros((n, n1))
+        X_full = np.r_[self.X_train, self.X_predict]
         start = time.time()
-        for b in range(B):
-            model = self.regressor
-            # NOTE: it is CRITICAL to clone the model, as o/w it will OVERFIT to the model across different iterations of bootstrap S_b.
-            # I originally did not understand that doing so is necessary but now know it
-            if self.regressor.__class__.__name__ == 'Sequential':
-                start1 = time.time()
-                model = clone_model(self.regressor)
-                opt = Adam(5e-4)
-                model.compile(loss='mean_squared_error', optimizer=opt)
-                callback = keras.callbacks.EarlyStopping(
-                    monitor='loss', patience=10)
-                bsize = int(0.1*len(np.unique(boot_samples_idx[b])))  # Was 0.1
-                if self.regressor.name == 'NeuralNet':
-                    # verbose definition here: https://keras.io/api/models/model_training_apis/#fit-method. 0 means silent
-                    # NOTE: I do NOT want epoches to be too large, as we then tend to be too close to the actual Y_t, NOT f(X_t).
-                    # Epoch was 250
-                    model.fit(self.X_train[boot_samples_idx[b], :], self.Y_train[boot_samples_idx[b], ],
-                              epochs=250, batch_size=bsize, callbacks=[callback], verbose=0)
+        if self.use_forest_OOB:
+            forest = clone(self.regressor).set_params(
+                n_estimators=B, bootstrap=True, max_samples=None)
+            in_boot_sample, boot_predictions = util.forest_OOB_predictions(
+                forest, self.X_train, self.Y_train, X_full)
+        else:
+            for b in range(B):
+                model = self.regressor
+                # NOTE: it is CRITICAL to clone the model, as o/w it will OVERFIT to the model across different iterations of bootstrap S_b.
+                # I originally did not understand that doing so is necessary but now know it
+                if self.regressor.__class__.__name__ == 'Sequential':
+                    start1 = time.time()
+                    model = clone_model(self.regressor)
+                    opt = Adam(5e-4)
+                    model.compile(loss='mean_squared_error', optimizer=opt)
+                    callback = keras.callbacks.EarlyStopping(
+                        monitor='loss', patience=10)
+                    bsize = int(0.1*len(np.unique(boot_samples_idx[b])))  # Was 0.1
+                    if self.regressor.name == 'NeuralNet':
+                        # verbose definition here: https://keras.io/api/models/model_training_apis/#fit-method. 0 means silent
+                        # NOTE: I do NOT want epoches to be too large, as we then tend to be too close to the actual Y_t, NOT f(X_t).
+                        # Epoch was 250
+                        model.fit(self.X_train[boot_samples_idx[b], :], self.Y_train[boot_samples_idx[b], ],
+                                  epochs=250, batch_size=bsize, callbacks=[callback], verbose=0)
+                    else:
+                        # This is RNN, mainly have different shape and decrease epochs for faster computation
+                        model.fit(self.X_train[boot_samples_idx[b], :], self.Y_train[boot_samples_idx[b], ],
+                                  epochs=10, batch_size=bsize, callbacks=[callback], verbose=0)
+                    # NOTE, this multiplied by B tells us total estimation time
+                    print(
+                        f'Took {time.time()-start1} secs to fit the {b}th boostrap model')
                 else:
-                    # This is RNN, mainly have different shape and decrease epochs for faster computation
-                    model.fit(self.X_train[boot_samples_idx[b], :], self.Y_train[boot_samples_idx[b], ],
-                              epochs=10, batch_size=bsize, callbacks=[callback], verbose=0)
-                # NOTE, this multiplied by B tells us total estimation time
-                print(
-                    f'Took {time.time()-start1} secs to fit the {b}th boostrap model')
-            else:
-                model = model.fit(self.X_train[boot_samples_idx[b], :],
-                                  self.Y_train[boot_samples_idx[b], ])
-            boot_predictions[b] = model.predict(
-                np.r_[self.X_train, self.X_predict]).flatten()
-            in_boot_sample[b, boot_samples_idx[b]] = True
+                    model = model.fit(self.X_train[boot_samples_idx[b], :],
+                                      self.Y_train[boot_samples_idx[b], ])
+                boot_predictions[b] = model.predict(X_full).flatten()
+                in_boot_sample[b, boot_samples_idx[b]] = True
         print(
             f'Finish Fitting B Bootstrap models, took {time.time()-start} secs.')
         start = time.time()
-        keep = []
-        for i in range(n):
-            b_keep = np.argwhere(~(in_boot_sample[:, i])).reshape(-1)
-            if(len(b_keep) > 0):
-                # NOTE: Append these training centers too see their magnitude
-                # The reason is sometimes they are TOO close to actual Y.
-                self.Ensemble_train_interval_centers.append(
-                    boot_predictions[b_keep, i].mean())
-                resid_LOO = self.Y_train[i] - \
-                    boot_predictions[b_keep, i].mean()
-                out_sample_predict[i] = boot_predictions[b_keep, n:].mean(0)
-                keep = keep+[b_keep]
-            else:  # if aggregating an empty set of models, predict zero everywhere
-                resid_LOO = self.Y_train[i]
-                out_sample_predict[i] = np.zeros(n1)
-            self.Ensemble_online_resid = np.append(
-                self.Ensemble_online_resid, resid_LOO)
-            keep = keep+[]
+        # Column i of W averages the f^b that did not use i in training. If there is no such f^b,
+        # the column is zero, i.e., we predict zero at i and in the test sample
+        b_keep = ~in_boot_sample
+        num_keep = b_keep.sum(0)
+        W = b_keep / np.maximum(num_keep, 1)
+        pred_LOO = (W * boot_predictions[:, :n]).sum(0)
+        # NOTE: Keep these training centers too see their magnitude
+        # The reason is sometimes they are TOO close to actual Y.
+        self.Ensemble_train_interval_centers = list(pred_LOO[num_keep > 0])
+        self.Ensemble_online_resid = np.asarray(self.Y_train - pred_LOO)
         # print(f'Max LOO training residual is {np.max(self.Ensemble_online_resid)}')
         # print(f'Min LOO training residual is {np.min(self.Ensemble_online_resid)}')
-        sorted_out_sample_predict = out_sample_predict.mean(
-            axis=0)  # length n1
+        # Mean over i of the LOO test predictions, without forming the n-by-n1 matrix
+        sorted_out_sample_predict = W.mean(1).dot(
+            boot_predictions[:, n:])  # length n1
         resid_out_sample = self.Y_predict-sorted_out_sample_predict
-        if len(miss_test_idx) > 0:
-            # Replace missing residuals with that from the immediate predecessor that is not missing, as
-            # o/w we are not assuming prediction data are missing
-            for l in range(len(miss_test_idx)):
-                i = miss_test_idx[l]
-                if i > 0:
-                    j = i-1
-                    while j in miss_test_idx[:l]:
-                        j -= 1
-                    resid_out_sample[i] = resid_out_sample[j]
-
-                else:
-                    # The first Y during testing is missing, let it be the last of the training residuals
-                    # note, training data already takes out missing values, so doing is is fine
-                    resid_out_sample[0] = self.Ensemble_online_resid[-1]
+        resid_out_sample = self.fill_missing_test_resid(
+            resid_out_sample, miss_test_idx)
         self.Ensemble_online_resid = np.append(
             self.Ensemble_online_resid, resid_out_sample)
         # print(f'Finish Computing LOO residuals, took {time.time()-start} secs.')
@@ -131,6 +122,46 @@ class prediction_interval():
         # print(f'Min LOO test residual is {np.min(self.Ensemble_online_resid[n:])}')
         self.Ensemble_pred_interval_centers = sorted_out_sample_predict
 
+    def fill_missing_test_resid(self, resid_out_sample, miss_test_idx):
+        '''
+            Replace missing residuals with that from the immediate predecessor that is not missing, as
+            o/w we are not assuming prediction data are missing
+        '''
+        if len(miss_test_idx) > 0:
+            # Position 0 holds the last of the training residuals, used if the first Ys during testing are missing
+            # note, training data already takes out missing values, so doing is is fine
+            resid = np.r_[self.Ensemble_online_resid[-1], resid_out_sample]
+            observed = np.ones(len(resid), dtype=bool)
+            observed[np.asarray(miss_test_idx) + 1] = False
+            # Linear-time forward fill: index of the latest observed residual at or before each position
+            last_observed = np.maximum.accumulate(
+                np.where(observed, np.arange(len(resid)), 0))
+            resid_out_sample = resid[last_observed][1:]
+        return resid_out_sample
+
+    def fit_ridge_jackknife_online(self, miss_test_idx):
+        '''
+          Exact jackknife+ alternative to fit_bootstrap_models_online for linear/ridge regressors (LinearRegression, Ridge, RidgeCV).
+          The LOO residuals and the average of the n LOO predictors on X_predict follow from one fit via the hat matrix, so no bootstrap refits are needed.
+          For RidgeCV, the penalty is selected once on the full training data and then held fixed.
+        '''
+        model = self.regressor
+        if hasattr(model, 'alphas'):
+            # RidgeCV: select the penalty once
+            alpha = model.fit(self.X_train, self.Y_train).alpha_
+        else:
+            alpha = getattr(model, 'alpha', 0)
+        resid_LOO, sorted_out_sample_predict = util.ridge_jackknife(
+            self.X_train, self.Y_train, self.X_predict, alpha, fit_intercept=model.fit_intercept)
+        self.Ensemble_train_interval_centers = list(self.Y_train-resid_LOO)
+        self.Ensemble_online_resid = np.array(resid_LOO)
+        resid_out_sample = self.Y_predict-sorted_out_sample_predict
+        resid_out_sample = self.fill_missing_test_resid(
+            resid_out_sample, miss_test_idx)
+        self.Ensemble_online_resid = np.append(
+            self.Ensemble_online_resid, resid_out_sample)
+        self.Ensemble_pred_interval_centers = sorted_out_sample_predict
+
     def compute_PIs_Ensemble_online(self, alpha, stride, smallT=False):
         # If smallT, we would only start with the last n number of LOO residuals, rather than use the full length T ones. Used in change detection
         ''' NOTE: smallT can be important if time-series is very dynamic, in which case training MORE data may actaully be worse (because quantile longer)'''
@@ -155,29 +186,14 @@ class prediction_interval():
         # gamma = 0.005
         # method = 'simple'  # 'simple' or 'complex'
         # self.alphas = []
-        for i in range(num_unique_resid):
-            # for p in range(stride):  # NEW for adaptive alpha
-            past_resid = resid_strided[i, :]
-            # The number of bins will be determined INSIDE binning
-            beta_hat_bin = util.binning(past_resid, alpha)
-            # beta_hat_bin = util.binning(past_resid, alpha_t)
-            self.beta_hat_bins.append(beta_hat_bin)
-            width_left[i] = np.percentile(
-                past_resid, math.ceil(100*beta_hat_bin))
-            width_right[i] = np.percentile(
-                past_resid, math.ceil(100*(1-alpha+beta_hat_bin)))
-            # width_right[i] = np.percentile(past_resid, math.ceil(100*(1-alpha_t+beta_hat_bin)))
-            # Y_t = self.Y_predict[i*stride+p]
-            # Y_t_hat = out_sample_predict[i*stride+p]
-            # lower_t, upper_t = Y_t_hat+width_left[i], Y_t_hat+width_right[i]
-            # err = 1 if Y_t < lower_t or Y_t > upper_t else 0
-            # errs.append(err)
-            # alpha_t = util.adjust_alpha_t(alpha_t, alpha, errs, gamma, method)
-            # if alpha_t > 1:
-            #     alpha_t = 1
-            # if alpha_t < 0:
-            #     alpha_t = 0
-            # self.alphas.append(alpha_t)
+        # The number of bins will be determined INSIDE binning_strided, which handles all windows at once
+        if n >= self.sorted_window_min:
+            beta_hat_bins, width_left, width_right = util.binning_sliding(
+                self.Ensemble_online_resid[len(self.X_train)-n:-1], n, alpha, stride)
+        else:
+            beta_hat_bins, width_left, width_right = util.binning_strided(
+                resid_strided, alpha)
+        self.beta_hat_bins.extend(beta_hat_bins)
         print(
             f'Finish Computing {num_unique_resid} UNIQUE Prediction Intervals, took {time.time()-start} secs.')
         # This is because |width|=T1/stride.
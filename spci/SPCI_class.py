@@ -10,10 +10,15 @@ import torch
 import pickle
 import matplotlib.pyplot as plt
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.linear_model import LinearRegression
+from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.base import clone
 import pdb
 from . import data
 import torch.nn as nn
+import multiprocessing
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Handle quantile_forest import conditionally
 try:
@@ -43,6 +48,37 @@ def detach_torch(input):
     return input.cpu().detach().numpy()
 
 
+def _SPCI_chunk_task(model, resid, w, rows, s):
+    '''
+        SPCI widths of one chunk of test indices, for the process pool of compute_PIs_Ensemble_online.
+        resid: the 1-D residual array, whose length-w windows are the rows of resid_strided
+    '''
+    model.QRF_ls, model.i_star_ls, model.leaf_dist_ls = [], [], []
+    model.refit_policy = utils.QRF_refit_policy(every=model.refit_policy.every)
+    model.refit_policy.reset(model.alpha)
+    wid = model.SPCI_widths(utils.strided_app(resid, w, 1), rows, s)
+    return wid, model.refit_policy, model.QRF_ls, model.i_star_ls
+
+
+def _one_boot_task(model, s, b, boot_idx, Xfull, torch_seed=None):
+    '''
+        Fit the b-th bootstrap model of the s-th multi-step predictor and predict on Xfull.
+        Module-level so that it can be shipped to a process pool; the serial path calls it too,
+        so both paths see the same bootstrap indices and (for the MLP) the same torch seed.
+        Returns the predictions of f^b and \sigma^b on Xfull, and the fitted models as a BootstrapModels block
+        (None unless model.keep_boot_models)
+    '''
+    model.b = b
+    N = len(boot_idx)
+    Xboot, Yboot = model.X_train[boot_idx, :], model.Y_train[s:s+N][boot_idx, ]
+    if torch_seed is None:
+        return model.one_boot_prediction(Xboot, Yboot, Xfull, return_model=True)
+    # Seed locally so the MLP initialization only depends on (s, b), not on which process runs it
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(torch_seed)
+        return model.one_boot_prediction(Xboot, Yboot, Xfull, return_model=True)
+
+
 class SPCI_and_EnbPI():
     '''
         Create prediction intervals assuming Y_t = f(X_t) + \sigma(X_t)\eps_t
@@ -74,17 +110,34 @@ class SPCI_and_EnbPI():
         # point predictor \hat f
         self.use_WLS = True # Whether to use WLS for fitting (compare with Nex-CP)
         self.WLS_c = 0.99
+        self.batch_MLP = False # If fit_func is None, train all B MLPs together as one stacked model
+        self.batch_linear = False # If fit_func is a plain LinearRegression/Ridge, solve all B normal equations at once
+        self.sorted_window_min = 2000 # EnbPI windows at least this long slide a SortedWindow instead of re-partitioning each window
+        self.use_forest_OOB = False # If fit_func is a forest, fit ONE bagged forest with B trees and use its trees as f^b
+        self.keep_boot_models = True # Keep the fitted f^b (and \sigma^b), so that SPCI_online_predictor can predict at new features
         # QRF training & how it treats the samples
         self.weigh_residuals = False # Whether we weigh current residuals more.
         self.c = 0.995 # If self.weight_residuals, weights[s] = self.c ** s, s\geq 0
+        self.decay_weights = None # utils.DecayWeights table of self.c ** s shared by all weighted fits, built on first use
         self.n_estimators = 10 # Num trees for QRF
         self.max_d = 2 # Max depth for fitting QRF
+        self.n_neighbors = 50 # Neighbours for quantile_regr='KNN'
         self.criterion = 'squared_error' # 'squared_error' or 'absolute_error'
+        self.QRF_threads = None # Threads training the stride-many multi-step QRFs of a refit concurrently, None = one per horizon (up to the cores), each forest using its share of the cores
+        self.random_state = None # Seed of every QRF fit, None = global np.random state
+        self.resid_featurizer = None # utils.ResidualFeaturizer mapping each window of past_window residuals to QRF features, None = raw lags
+        self.online_RF_rebuild_every = None # 'online_RF' refits its tree splits after this many insertions, None = whenever the training window has been replaced, np.inf = never
+        self.quantile_regr = 'RF' # Quantile regressor of SPCI: 'RF' refits a QRF every time, 'online_RF' updates one in place, 'LR' linear quantile regression, 'KNN' nearest lag vectors
         # search of \beta^* \in [0,\alpha]
         self.bins = 5 # break [0,\alpha] into bins
         # how many LOO training residuals to use for training current QRF 
-        self.T1 = None # None = use all
-    def one_boot_prediction(self, Xboot, Yboot, Xfull):
+        self.T1 = None # None = use all. Otherwise SPCI only keeps the residuals these T1 samples need, so per-step cost and memory stay flat
+    def one_boot_prediction(self, Xboot, Yboot, Xfull, return_model=False):
+        '''
+            return_model: if True, also return the fitted models as a BootstrapModels block (None for NeuralProphet,
+                or if not self.keep_boot_models)
+        '''
+        block = None
         if self.use_NeuralProphet:
             '''
                 Added NeuralPropeht in
@@ -115,10 +168,10 @@ class SPCI_and_EnbPI():
                     optimizer_sigma = torch.optim.Adam(
                         model_sigma.parameters(), lr=2e-3)
                 for epoch in range(300):
-                    fXhat = model_f(Xboot)
+                    fXhat = model_f(Xboot).flatten()
                     sigmaXhat = torch.ones(len(fXhat)).to(device)
                     if self.fit_sigmaX:
-                        sigmaXhat = model_sigma(Xboot)
+                        sigmaXhat = model_sigma(Xboot).flatten()
                     loss = ((Yboot - fXhat)
                             / sigmaXhat).pow(2).mean() / 2
                     optimizer_f.zero_grad()
@@ -137,11 +190,13 @@ class SPCI_and_EnbPI():
                             Xfull).flatten().cpu().detach().numpy()
                 print(
                     f'Took {time.time()-start1} secs to finish the {self.b}th boostrap model')
+                block = ('MLP', model_f, model_sigma if self.fit_sigmaX else None)
             else:
                 Xboot, Yboot = detach_torch(Xboot), detach_torch(Yboot)
                 Xfull = detach_torch(Xfull)
                 # NOTE, NO sigma estimation because these methods by deFAULT are fitting Y, but we have no observation of errors
-                model = self.regressor
+                # A copy per f^b, so that the fitted models can be kept
+                model = clone(self.regressor, safe=False)
                 if self.use_WLS and isinstance(model,LinearRegression):
                     # To compare with Nex-CP when using WLS
                     # Taken from Nex-CP code
@@ -153,9 +208,53 @@ class SPCI_and_EnbPI():
                 boot_fX_pred = torch.from_numpy(
                     model.predict(Xfull).flatten()).to(device)
                 boot_sigma_pred = 0
+                block = ('sklearn', model, None)
+            if return_model:
+                return boot_fX_pred, boot_sigma_pred, block if self.keep_boot_models else None
             return boot_fX_pred, boot_sigma_pred
 
-    def fit_bootstrap_models_online_multistep(self, B, fit_sigmaX=True, stride=1):
+    def batched_boot_prediction(self, Xboot, Yboot, Xfull, return_model=False):
+        '''
+            Train the B default MLPs (and sigma MLPs) together as one stacked model
+            Xboot: B-by-N-by-d, row b holds the b-th bootstrap sample; Yboot: B-by-N
+            Return: B-by-len(Xfull) predictions of f and \sigma (the latter all ones if not fit_sigmaX)
+                and, if return_model, the stacked models as a BootstrapModels block
+        '''
+        start1 = time.time()
+        B = Xboot.shape[0]
+        model_f = BatchedMLP(self.d, B).to(device)
+        optimizer_f = torch.optim.Adam(model_f.parameters(), lr=1e-3)
+        if self.fit_sigmaX:
+            model_sigma = BatchedMLP(self.d, B, sigma=True).to(device)
+            optimizer_sigma = torch.optim.Adam(
+                model_sigma.parameters(), lr=2e-3)
+        for epoch in range(300):
+            fXhat = model_f(Xboot)
+            sigmaXhat = torch.ones_like(fXhat)
+            if self.fit_sigmaX:
+                sigmaXhat = model_sigma(Xboot)
+            # Sum of per-model losses, so each member gets exactly its own gradient (Adam is elementwise)
+            loss = ((Yboot - fXhat) / sigmaXhat).pow(2).mean(1).sum() / 2
+            optimizer_f.zero_grad()
+            if self.fit_sigmaX:
+                optimizer_sigma.zero_grad()
+            loss.backward()
+            optimizer_f.step()
+            if self.fit_sigmaX:
+                optimizer_sigma.step()
+        with torch.no_grad():
+            Xfull = Xfull.unsqueeze(0).expand(B, -1, -1)
+            boot_fX_pred = detach_torch(model_f(Xfull))
+            boot_sigma_pred = np.ones_like(boot_fX_pred)
+            if self.fit_sigmaX:
+                boot_sigma_pred = detach_torch(model_sigma(Xfull))
+        print(
+            f'Took {time.time()-start1} secs to finish the {B} batched boostrap models')
+        if return_model:
+            return boot_fX_pred, boot_sigma_pred, ('batched_MLP', model_f, model_sigma if self.fit_sigmaX else None)
+        return boot_fX_pred, boot_sigma_pred
+
+    def fit_bootstrap_models_online_multistep(self, B, fit_sigmaX=True, stride=1, n_jobs=1, executor=None, seed=None):
         '''
           Train B bootstrap estimators from subsets of (X_train, Y_train), compute aggregated predictors, and compute the residuals
           fit_sigmaX: If False, just avoid predicting \sigma(X_t) by defaulting it to 1
@@ -164,6 +263,13 @@ class SPCI_and_EnbPI():
             Idea: train on (X_i,Y_i), i=1,...,n-stride
             Then predict on X_1,X_{1+s},...,X_{1+k*s} where 1+k*s <= n+n1
             Note, when doing LOO prediction thus only care above the points above
+
+          n_jobs: int. Number of worker processes used to fit the stride*B bootstrap models. 1 = serial, -1 = all cores.
+          executor: optional concurrent.futures.Executor used instead of the pool built from n_jobs.
+            All bootstrap indices (and MLP seeds) are drawn up front in the serial order, so the
+            bootstrap predictions are identical to the serial path for a given seed.
+          seed: None uses the global np.random (and torch) state. Otherwise an int or np.random.SeedSequence, from which every
+            multi-step predictor and every f^b gets its own child stream for the bootstrap indices and the MLP initialization.
         '''
         n, self.d = self.X_train.shape
         self.fit_sigmaX = fit_sigmaX
@@ -179,76 +285,117 @@ class SPCI_and_EnbPI():
         Xfull = torch.vstack(
             [self.X_train[train_pred_idx], self.X_predict[test_pred_idx-n]])
         nsub, n1sub = len(train_pred_idx), len(test_pred_idx)
+        # hold indices of training data for each f^b, drawn for all multi-step predictors before any fitting
+        # (the OOB forest mode draws them inside the forest instead)
+        boot_seeds, torch_seed_seq = [None]*stride, None
+        if seed is not None:
+            if not isinstance(seed, np.random.SeedSequence):
+                seed = np.random.SeedSequence(seed)
+            boot_seed_seq, torch_seed_seq = seed.spawn(2)
+            boot_seeds = boot_seed_seq.spawn(stride)
+        boot_samples_idx_ls = [None if self.use_forest_OOB else utils.generate_bootstrap_samples(
+            N, N, B, seed=boot_seeds[s]) for s in range(stride)]
+        torch_seeds = [[None]*B for _ in range(stride)]
+        use_MLP = self.regressor.__class__.__name__ == 'NoneType' and not self.use_NeuralProphet
+        batch_MLP = use_MLP and self.batch_MLP
+        # Linear and ridge bootstrap models all follow from one batched solve of their normal equations,
+        # which only covers alpha and fit_intercept: constrained or non-default solvers keep the sklearn fits
+        batch_linear = self.batch_linear and type(self.regressor) in (LinearRegression, Ridge) and np.ndim(
+            getattr(self.regressor, 'alpha', 0)) == 0 and not getattr(self.regressor, 'positive', False) and \
+            getattr(self.regressor, 'solver', 'auto') == 'auto' and not self.use_NeuralProphet
+        # These modes produce all B models in one fit, so there is nothing to fan out
+        one_fit = batch_MLP or batch_linear or self.use_forest_OOB
+        if use_MLP and torch_seed_seq is not None:
+            torch_seeds = np.random.default_rng(torch_seed_seq).integers(
+                0, 2**31 - 1, (stride, B)).tolist()
+        elif use_MLP:
+            torch_seeds = torch.randint(0, 2**31 - 1, (stride, B)).tolist()
+        if self.use_NeuralProphet:
+            self.df_full, self.Xnames = utils.make_NP_df(
+                Xfull, np.zeros(n + n1))
+        self.boot_results_ls = []  # (in_boot_sample, boot_predictionsFX, boot_predictionsSigmaX) per multi-step predictor
+        self.boot_models_ls = []  # BootstrapModels per multi-step predictor, None if not kept
+        self.test_weights_ls = []  # weights of the f^b in the test predictions, per multi-step predictor
+        own_executor = executor is None and n_jobs != 1 and not one_fit
+        if own_executor:
+            # 'spawn' avoids forking a process that already holds torch/OpenMP thread pools
+            executor = ProcessPoolExecutor(max_workers=None if n_jobs == -1 else n_jobs,
+                                           mp_context=multiprocessing.get_context('spawn'))
+        futures = None
+        if executor is not None and not one_fit:
+            # Fan out all stride*B fits at once; they are collected below in the serial order
+            futures = [[executor.submit(_one_boot_task, self, s, b, boot_samples_idx_ls[s][b], Xfull,
+                                        torch_seeds[s][b]) for b in range(B)] for s in range(stride)]
         for s in range(stride):
             ''' 1. Create containers for predictions '''
-            # hold indices of training data for each f^b
-            boot_samples_idx = utils.generate_bootstrap_samples(N, N, B)
+            boot_samples_idx = boot_samples_idx_ls[s]
             # for i^th column, it shows which f^b uses i in training (so exclude in aggregation)
             in_boot_sample = np.zeros((B, N), dtype=bool)
             # hold predictions from each f^b for fX and sigma&b for sigma
             boot_predictionsFX = np.zeros((B, nsub+n1sub))
             boot_predictionsSigmaX = np.ones((B, nsub+n1sub))
-            # We actually would just use n1sub rows, as we only observe this number of features
-            out_sample_predictFX = np.zeros((n, n1sub))
-            out_sample_predictSigmaX = np.ones((n, n1sub))
 
             ''' 2. Start bootstrap prediction '''
             start = time.time()
-            if self.use_NeuralProphet:
-                self.df_full, self.Xnames = utils.make_NP_df(
-                    Xfull, np.zeros(n + n1))
-            for b in range(B):
-                self.b = b
-                Xboot, Yboot = self.X_train[boot_samples_idx[b],
-                                            :], self.Y_train[s:s+N][boot_samples_idx[b], ]
-                in_boot_sample[b, boot_samples_idx[b]] = True
-                boot_fX_pred, boot_sigma_pred = self.one_boot_prediction(
-                    Xboot, Yboot, Xfull)
-                boot_predictionsFX[b] = boot_fX_pred
-                if self.fit_sigmaX:
-                    boot_predictionsSigmaX[b] = boot_sigma_pred
+            blocks = []
+            if self.use_forest_OOB:
+                # Tree b of a bagged forest is a bootstrap model, with its in-bag rows as bootstrap sample
+                forest = clone(self.regressor).set_params(
+                    n_estimators=B, bootstrap=True, max_samples=None)
+                in_boot_sample, boot_predictionsFX = utils.forest_OOB_predictions(
+                    forest, detach_torch(self.X_train[:N]), detach_torch(self.Y_train[s:s+N]), detach_torch(Xfull))
+                blocks.append(('forest', forest, None))
+            else:
+                for b in range(B):
+                    in_boot_sample[b, boot_samples_idx[b]] = True
+            if batch_linear:
+                tags = None
+                if self.use_WLS and isinstance(self.regressor, LinearRegression):
+                    # Same weights as one_boot_prediction: by position within the bootstrap sample
+                    tags = self.WLS_c**(np.arange(N, 0, -1))
+                boot_weights = utils.bootstrap_counts(boot_samples_idx, N, tags)
+                boot_predictionsFX, coef = utils.batched_linear_boot_predictions(
+                    detach_torch(self.X_train[:N]), detach_torch(self.Y_train[s:s+N]), detach_torch(Xfull),
+                    boot_weights, alpha=getattr(self.regressor, 'alpha', 0),
+                    fit_intercept=self.regressor.fit_intercept, return_coef=True)
+                blocks.append(('linear', coef, self.regressor.fit_intercept))
+            elif batch_MLP:
+                Xboot = self.X_train[boot_samples_idx]
+                Yboot = self.Y_train[s:s+N][boot_samples_idx]
+                with torch.random.fork_rng(devices=[]):
+                    torch.manual_seed(torch_seeds[s][0])
+                    boot_predictionsFX, boot_predictionsSigmaX, block = self.batched_boot_prediction(
+                        Xboot, Yboot, Xfull, return_model=True)
+                blocks.append(block)
+            elif not self.use_forest_OOB:
+                for b in range(B):
+                    if futures is None:
+                        boot_fX_pred, boot_sigma_pred, block = _one_boot_task(
+                            self, s, b, boot_samples_idx[b], Xfull, torch_seeds[s][b])
+                    else:
+                        boot_fX_pred, boot_sigma_pred, block = futures[s][b].result()
+                    blocks.append(block)
+                    boot_predictionsFX[b] = boot_fX_pred
+                    if self.fit_sigmaX:
+                        boot_predictionsSigmaX[b] = boot_sigma_pred
             print(
                 f'{s+1}/{stride} multi-step: finish Fitting {B} Bootstrap models, took {time.time()-start} secs.')
 
             ''' 3. Obtain LOO residuals (train and test) and prediction for test data '''
-            start = time.time()
-            # Consider LOO, but here ONLY for the indices being predicted
-            for j, i in enumerate(train_pred_idx):
-                # j: counter and i: actual index X_{0+j*stride}
-                if i < N:
-                    b_keep = np.argwhere(
-                        ~(in_boot_sample[:, i])).reshape(-1)
-                    if len(b_keep) == 0:
-                        # All bootstrap estimators are trained on this model
-                        b_keep = 0  # More rigorously, it should be None, but in practice, the difference is minor
-                else:
-                    # This feature is not used in training, but used in prediction
-                    b_keep = range(B)
-                pred_iFX = boot_predictionsFX[b_keep, j].mean()
-                pred_iSigmaX = boot_predictionsSigmaX[b_keep, j].mean()
-                pred_testFX = boot_predictionsFX[b_keep, nsub:].mean(0)
-                pred_testSigmaX = boot_predictionsSigmaX[b_keep, nsub:].mean(0)
-                # Populate the training prediction
-                # We add s because of multi-step procedure, so f(X_t) is for Y_t+s
-                true_idx = min(i+s, n-1)
-                self.Ensemble_train_interval_centers[true_idx] = pred_iFX
-                self.Ensemble_train_interval_sigma[true_idx] = pred_iSigmaX
-                resid_LOO = (detach_torch(
-                    self.Y_train[true_idx]) - pred_iFX) / pred_iSigmaX
-                out_sample_predictFX[i] = pred_testFX
-                out_sample_predictSigmaX[i] = pred_testSigmaX
-                self.Ensemble_online_resid[true_idx] = resid_LOO.item()
-            sorted_out_sample_predictFX = out_sample_predictFX[train_pred_idx].mean(
-                0)  # length ceil(n1/stride)
-            sorted_out_sample_predictSigmaX = out_sample_predictSigmaX[train_pred_idx].mean(
-                0)  # length ceil(n1/stride)
-            pred_idx = np.minimum(test_pred_idx-n+s, n1-1)
-            self.Ensemble_pred_interval_centers[pred_idx] = sorted_out_sample_predictFX
-            self.Ensemble_pred_interval_sigma[pred_idx] = sorted_out_sample_predictSigmaX
-            pred_full_idx = np.minimum(test_pred_idx+s, n+n1-1)
-            resid_out_sample = (
-                detach_torch(self.Y_predict[pred_idx]) - sorted_out_sample_predictFX) / sorted_out_sample_predictSigmaX
-            self.Ensemble_online_resid[pred_full_idx] = resid_out_sample
+            self.aggregate_LOO(s, in_boot_sample,
+                               boot_predictionsFX, boot_predictionsSigmaX)
+            self.boot_results_ls.append(
+                (in_boot_sample, boot_predictionsFX, boot_predictionsSigmaX))
+            keep = self.keep_boot_models and all(block is not None for block in blocks)
+            self.boot_models_ls.append(BootstrapModels(blocks) if keep else None)
+            if stride == 1:
+                # Keep the bootstrap bookkeeping so that append_training can update it
+                self.in_boot_sample = in_boot_sample
+                self.boot_predictionsFX = boot_predictionsFX
+                self.boot_predictionsSigmaX = boot_predictionsSigmaX
+                self.boot_available = np.ones((B, nsub), dtype=bool)
+        if own_executor:
+            executor.shutdown()
         # Sanity check
         num_inf = (self.Ensemble_online_resid == np.inf).sum()
         if num_inf > 0:
@@ -256,20 +403,220 @@ class SPCI_and_EnbPI():
                 f'Something can be wrong, as {num_inf}/{n+n1} residuals are not all computed')
             print(np.where(self.Ensemble_online_resid == np.inf))
 
-    def compute_PIs_Ensemble_online(self, alpha, stride=1, smallT=True, past_window=100, use_SPCI=False, quantile_regr='RF'):
+    def fit_bootstrap_models_anytime(self, B_max, B_batch=10, tol=0.01, time_budget=None, alpha=0.1,
+                                     fit_sigmaX=True, stride=1, n_jobs=1, executor=None, seed=None):
+        '''
+          Anytime version of fit_bootstrap_models_online_multistep: add B_batch bootstrap models at a time until
+            (a) the alpha/2 and 1-alpha/2 quantiles of the LOO training residuals move by less than tol * their distance, or
+            (b) fitting another batch would exceed time_budget (in secs), or
+            (c) B_max models have been fit.
+          The number of models actually used is stored in self.B_used.
+          seed: as in fit_bootstrap_models_online_multistep; batch k uses the k-th child of the seed,
+            so the first batches do not depend on B_max, B_batch or the stopping point.
+        '''
+        if self.use_forest_OOB:
+            raise ValueError(
+                'The OOB forest mode fits one forest of B trees, so it has no batches to add')
+        if seed is not None and not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        own_executor = executor is None and n_jobs != 1
+        if own_executor:
+            # Reuse one pool across batches rather than spawning it B_max/B_batch times
+            executor = ProcessPoolExecutor(max_workers=None if n_jobs == -1 else n_jobs,
+                                           mp_context=multiprocessing.get_context('spawn'))
+        n = len(self.X_train)
+        self.B_used = 0
+        results_ls, q_old = None, None
+        start = time.time()
+        while self.B_used < B_max:
+            start_batch = time.time()
+            B = min(B_batch, B_max - self.B_used)
+            self.fit_bootstrap_models_online_multistep(
+                B, fit_sigmaX=fit_sigmaX, stride=stride, executor=executor,
+                seed=None if seed is None else seed.spawn(1)[0])
+            self.B_used += B
+            if results_ls is None:
+                results_ls, models_ls = self.boot_results_ls, self.boot_models_ls
+            else:
+                results_ls = [tuple(np.vstack([old, new]) for old, new in zip(old_res, new_res))
+                              for old_res, new_res in zip(results_ls, self.boot_results_ls)]
+                models_ls = [None if old is None or new is None else old + new
+                             for old, new in zip(models_ls, self.boot_models_ls)]
+                for s, res in enumerate(results_ls):
+                    self.aggregate_LOO(s, *res)
+            resid = self.Ensemble_online_resid[:n]
+            q_new = np.quantile(resid[np.isfinite(resid)], [alpha/2, 1-alpha/2])
+            converged = q_old is not None and np.abs(
+                q_new-q_old).max() <= tol * (q_new[1]-q_new[0])
+            q_old = q_new
+            if converged:
+                break
+            if time_budget is not None and time.time()-start + (time.time()-start_batch) > time_budget:
+                break
+        if own_executor:
+            executor.shutdown()
+        self.boot_results_ls, self.boot_models_ls = results_ls, models_ls
+        if stride == 1:
+            self.in_boot_sample, self.boot_predictionsFX, self.boot_predictionsSigmaX = results_ls[0]
+            self.boot_available = np.ones(
+                self.in_boot_sample.shape, dtype=bool)
+        print(
+            f'Anytime fitting used {self.B_used}/{B_max} Bootstrap models, took {time.time()-start} secs.')
+
+    def aggregate_LOO(self, s, in_boot_sample, boot_predictionsFX, boot_predictionsSigmaX, available=None):
+        '''
+            Obtain LOO residuals (train and test) and prediction for test data of the s-th multi-step predictor
+            available: optional B-by-len(self.train_idx) mask of which f^b have a prediction at each training feature
+        '''
+        n, n1 = len(self.X_train), len(self.X_predict)
+        train_pred_idx, test_pred_idx = self.train_idx, self.test_idx
+        nsub = len(train_pred_idx)
+        # Consider LOO, but here ONLY for the indices being predicted
+        # Column j of W averages the f^b that did not see X_{train_pred_idx[j]}, so every LOO
+        # center/sigma and the out-of-sample mean are a few (B, nsub+n1sub) products
+        W = utils.LOO_weights(in_boot_sample, train_pred_idx, available)
+        pred_iFX = (W * boot_predictionsFX[:, :nsub]).sum(0)
+        pred_iSigmaX = (W * boot_predictionsSigmaX[:, :nsub]).sum(0)
+        # Populate the training prediction
+        # We add s because of multi-step procedure, so f(X_t) is for Y_t+s
+        true_idx = np.minimum(train_pred_idx+s, n-1)
+        self.Ensemble_train_interval_centers[true_idx] = pred_iFX
+        self.Ensemble_train_interval_sigma[true_idx] = pred_iSigmaX
+        self.Ensemble_online_resid[true_idx] = (detach_torch(
+            self.Y_train[true_idx]) - pred_iFX) / pred_iSigmaX
+        # Averaging the LOO test predictions over i equals weighting f^b by the row-mean of W
+        W_bar = W.mean(1)
+        # Kept to aggregate the f^b at new features (predict_center); the s-th predictor is aggregated after the (s-1)-th
+        self.test_weights_ls[s:s+1] = [W_bar]
+        sorted_out_sample_predictFX = W_bar.dot(
+            boot_predictionsFX[:, nsub:])  # length ceil(n1/stride)
+        sorted_out_sample_predictSigmaX = W_bar.dot(
+            boot_predictionsSigmaX[:, nsub:])  # length ceil(n1/stride)
+        pred_idx = np.minimum(test_pred_idx-n+s, n1-1)
+        self.Ensemble_pred_interval_centers[pred_idx] = sorted_out_sample_predictFX
+        self.Ensemble_pred_interval_sigma[pred_idx] = sorted_out_sample_predictSigmaX
+        pred_full_idx = np.minimum(test_pred_idx+s, n+n1-1)
+        resid_out_sample = (
+            detach_torch(self.Y_predict[pred_idx]) - sorted_out_sample_predictFX) / sorted_out_sample_predictSigmaX
+        self.Ensemble_online_resid[pred_full_idx] = resid_out_sample
+
+    def predict_center(self, X, s=0):
+        '''
+            \hat f and \hat \sigma of the s-th multi-step predictor at new features X (one row each), aggregating the
+            kept f^b (and \sigma^b) with the weights aggregate_LOO gives the test data
+        '''
+        models = self.boot_models_ls[s] if len(getattr(self, 'boot_models_ls', [])) > s else None
+        if models is None:
+            raise ValueError(
+                'predict_center needs the bootstrap models, which fit_bootstrap_models_online_multistep keeps if keep_boot_models (not with NeuralProphet)')
+        X = torch.as_tensor(X, dtype=self.X_train.dtype).reshape(-1, self.d)
+        fX, sigmaX = models.predict(X)
+        W_bar = self.test_weights_ls[s]
+        return W_bar.dot(fX), W_bar.dot(sigmaX)
+
+    def append_training(self, X_new, Y_new, refit_frac=0.2, seed=None):
+        '''
+            Add newly labelled observations to the training data without refitting the whole ensemble (stride = 1 only)
+            Only round(refit_frac*B) f^b (at least one) are refit, in rotation across calls, on fresh bootstrap samples of all training data.
+            The other f^b never saw the new points, so they count as out-of-bag there; as they were not evaluated on X_new,
+            they are simply left out of the LOO average at the new points.
+            seed: as in fit_bootstrap_models_online_multistep, for the bootstrap samples (and MLP initialisations) of the refit f^b
         '''
+        if not hasattr(self, 'in_boot_sample') or len(self.train_idx) != len(self.X_train):
+            raise ValueError(
+                'append_training needs a previous fit_bootstrap_models_online_multistep with stride=1')
+        if self.use_forest_OOB:
+            raise ValueError(
+                'append_training does not support the OOB forest mode, as its trees come from one fit')
+        X_new = torch.as_tensor(X_new, dtype=self.X_train.dtype).reshape(-1, self.d)
+        Y_new = torch.as_tensor(Y_new, dtype=self.Y_train.dtype).reshape(-1)
+        n, n1, m = len(self.X_train), len(self.X_predict), len(X_new)
+        B = len(self.in_boot_sample)
+        self.X_train = torch.vstack([self.X_train, X_new])
+        self.Y_train = torch.cat([self.Y_train, Y_new])
+        self.train_idx = np.arange(n+m)
+        self.test_idx = np.arange(n+m, n+m+n1)
+        # Grow the bookkeeping: new training columns go between the old training and the test columns
+        self.in_boot_sample = np.c_[self.in_boot_sample,
+                                    np.zeros((B, m), dtype=bool)]
+        self.boot_available = np.c_[self.boot_available,
+                                    np.zeros((B, m), dtype=bool)]
+        self.boot_predictionsFX = np.insert(
+            self.boot_predictionsFX, [n]*m, 0, axis=1)
+        self.boot_predictionsSigmaX = np.insert(
+            self.boot_predictionsSigmaX, [n]*m, 1, axis=1)
+        # Refit the next members in the rotation on all n+m training points
+        num_refit = min(B, max(1, int(round(refit_frac * B))))
+        pointer = getattr(self, 'refit_pointer', 0)
+        refit_ls = (pointer + np.arange(num_refit)) % B
+        self.refit_pointer = (pointer + num_refit) % B
+        torch_seed_seq = None
+        if seed is not None:
+            # Same split of the seed as in fit_bootstrap_models_online_multistep
+            if not isinstance(seed, np.random.SeedSequence):
+                seed = np.random.SeedSequence(seed)
+            seed, torch_seed_seq = seed.spawn(2)
+        boot_samples_idx = utils.generate_bootstrap_samples(
+            n+m, n+m, num_refit, seed=seed)
+        torch_seeds = [None]*num_refit
+        if self.regressor.__class__.__name__ == 'NoneType' and not self.use_NeuralProphet:
+            if torch_seed_seq is not None:
+                torch_seeds = np.random.default_rng(torch_seed_seq).integers(
+                    0, 2**31 - 1, num_refit).tolist()
+            else:
+                torch_seeds = torch.randint(0, 2**31 - 1, (num_refit,)).tolist()
+        Xfull = torch.vstack([self.X_train, self.X_predict])
+        start = time.time()
+        for boot_idx, b, torch_seed in zip(boot_samples_idx, refit_ls, torch_seeds):
+            boot_fX_pred, boot_sigma_pred, block = _one_boot_task(
+                self, 0, b, boot_idx, Xfull, torch_seed)
+            if self.boot_models_ls[0] is not None:
+                self.boot_models_ls[0].members[b] = block
+            self.in_boot_sample[b] = False
+            self.in_boot_sample[b, boot_idx] = True
+            self.boot_available[b] = True
+            self.boot_predictionsFX[b] = boot_fX_pred
+            if self.fit_sigmaX:
+                self.boot_predictionsSigmaX[b] = boot_sigma_pred
+        print(
+            f'Refit {num_refit}/{B} Bootstrap models on {m} new observations, took {time.time()-start} secs.')
+        # Re-aggregate the LOO residuals, which is cheap compared to the refits
+        self.Ensemble_train_interval_centers = np.ones(n+m)*np.inf
+        self.Ensemble_train_interval_sigma = np.ones(n+m)*np.inf
+        self.Ensemble_online_resid = np.r_[np.ones(m)*np.inf, self.Ensemble_online_resid]
+        self.aggregate_LOO(0, self.in_boot_sample, self.boot_predictionsFX,
+                           self.boot_predictionsSigmaX, self.boot_available)
+
+    def compute_PIs_Ensemble_online(self, alpha, stride=1, smallT=True, past_window=100, use_SPCI=False, quantile_regr=None,
+                                    refit_policy=None, n_jobs=1, executor=None, num_chunks=None):
+        '''
+            alpha: significance level, or a list of them. For a list, every QRF is trained once on the union of the quantile
+                levels all of them need (EnbPI sorts each window once), and PIs_Ensemble has columns (alpha, 'lower'/'upper')
             stride: control how many steps we predict ahead
             smallT: if True, we would only start with the last n number of LOO residuals, rather than use the full length T ones. Used in change detection
                 NOTE: smallT can be important if time-series is very dynamic, in which case training MORE data may actaully be worse (because quantile longer)
                 HOWEVER, if fit quantile regression, set it to be FALSE because we want to have many training pts for the quantile regressor
             use_SPCI: if True, we fit conditional quantile to compute the widths, rather than simply using empirical quantile
+            quantile_regr: quantile regressor of SPCI, None = self.quantile_regr
+            refit_policy: utils.QRF_refit_policy deciding when SPCI refits its QRFs. None = refit every stride steps
+            n_jobs, executor: as in fit_bootstrap_models_online_multistep. With SPCI and a fixed refit schedule (only `every`),
+                the test indices are split into chunks that each start at a refit, and the chunks run in a process pool.
+                Results equal the serial loop when self.random_state fixes the QRFs.
+            num_chunks: number of such chunks. None = n_jobs, or the number of cores for n_jobs=-1 or an executor with n_jobs=1
         '''
-        self.alpha = alpha
+        self.alpha = alpha if np.ndim(alpha) == 0 else np.asarray(alpha, dtype=float)
+        if quantile_regr is None:
+            quantile_regr = self.quantile_regr
+        self.quantile_regr = quantile_regr
+        self.quantiles, self.quantile_idx = self.QRF_quantiles()
         n1 = len(self.X_train)
         self.past_window = past_window # For SPCI, this is the "lag" for predicting quantile
         if smallT:
             # Namely, for special use of EnbPI, only use at most past_window number of LOO residuals.
             n1 = min(self.past_window, len(self.X_train))
+        if use_SPCI and self.T1 is not None:
+            # Windows longer than the bounded QRF history would never be read
+            n1 = min(n1, self.SPCI_history(past_window, stride))
         # Now f^b and LOO residuals have been constructed from earlier
         out_sample_predict = self.Ensemble_pred_interval_centers
         out_sample_predictSigmaX = self.Ensemble_pred_interval_sigma
@@ -294,66 +641,78 @@ class SPCI_and_EnbPI():
         # NOTE: 'max_features='log2', max_depth=2' make the model "simpler", which improves performance in practice
         self.QRF_ls = []
         self.i_star_ls = []
-        for i in range(num_unique_resid):
-            curr_SigmaX = out_sample_predictSigmaX[i].item()
-            if use_SPCI:
-                remainder = i % s
-                if remainder == 0:
-                    # Update QRF
-                    past_resid = resid_strided[i, :]
-                    n2 = self.past_window
-                    resid_pred = self.multi_step_QRF(past_resid, i, s, n2)
-                # Use the fitted regressor.
-                # NOTE, residX is NOT the same as before, as it depends on
-                # "past_resid", which has most entries replaced.
-                rfqr= self.QRF_ls[remainder]
-                i_star = self.i_star_ls[remainder]
-
-                # quantile-forest requires explicit quantiles parameter
-                if hasattr(rfqr, 'default_quantiles') and rfqr.default_quantiles is not None:
-                    # Convert numpy array to list for quantile-forest compatibility
-                    quantiles_list = rfqr.default_quantiles.tolist() if hasattr(rfqr.default_quantiles, 'tolist') else rfqr.default_quantiles
-                    wid_all = rfqr.predict(resid_pred, quantiles=quantiles_list)
-                    # quantile-forest returns shape (n_samples, n_quantiles), need to flatten
-                    wid_all = wid_all.flatten()
-                else:
-                    # Fallback for non-quantile regressors
-                    wid_all = rfqr.predict(resid_pred)
-
-                num_mid = int(len(wid_all)/2)
-                wid_left = wid_all[i_star]
-                wid_right = wid_all[num_mid+i_star]
-                width_left[i] = curr_SigmaX * wid_left
-                width_right[i] = curr_SigmaX * wid_right
-                num_print = int(num_unique_resid / 20)
-                if num_print == 0:
-                    print(
-                            f'Width at test {i} is {width_right[i]-width_left[i]}')
-                else:
-                    if i % num_print == 0:
-                        print(
-                            f'Width at test {i} is {width_right[i]-width_left[i]}')
+        self.leaf_dist_ls = []  # (feature, utils.LeafDistribution) each QRF was last trained with
+        if self.resid_featurizer is not None:
+            self.resid_featurizer.clear()
+        self.refit_policy = utils.QRF_refit_policy() if refit_policy is None else refit_policy
+        self.refit_policy.reset(self.alpha)
+        # Widths are num_unique_resid-by-len(alpha) for a list of alpha
+        curr_SigmaX = out_sample_predictSigmaX[:num_unique_resid].reshape((-1,) + (1,) * np.ndim(self.alpha))
+        if not use_SPCI:
+            # Naive empirical quantile, where we use the SAME residuals for multi-step prediction
+            # All windows are handled in one batched pass
+            if n1 >= self.sorted_window_min:
+                beta_hat_bins, width_left, width_right = utils.binning_sliding(
+                    self.Ensemble_online_resid[len(self.X_train) - n1:-1], n1, self.alpha, stride)
             else:
-                past_resid = resid_strided[i, :]
-                # Naive empirical quantile, where we use the SAME residuals for multi-step prediction
-                # The number of bins will be determined INSIDE binning
-                beta_hat_bin = utils.binning(past_resid, alpha)
-                # beta_hat_bin = utils.binning(past_resid, alpha_t)
-                self.beta_hat_bins.append(beta_hat_bin)
-                width_left[i] = curr_SigmaX * np.percentile(
-                    past_resid, math.ceil(100 * beta_hat_bin))
-                width_right[i] = curr_SigmaX * np.percentile(
-                    past_resid, math.ceil(100 * (1 - alpha + beta_hat_bin)))
+                beta_hat_bins, width_left, width_right = utils.binning_strided(
+                    resid_strided, self.alpha)
+            self.beta_hat_bins.extend(beta_hat_bins)
+            width_left, width_right = curr_SigmaX * width_left, curr_SigmaX * width_right
+        else:
+            policy = self.refit_policy
+            # Fixed schedule: with refits every `period` steps, chunks starting at multiples of period see the same refits
+            period = None if policy.every is None else s * math.ceil(policy.every / s)
+            # Incrementally updated regressors carry state from all earlier steps, so they cannot start mid-way either
+            parallel = (n_jobs != 1 or executor is not None) and period is not None and \
+                policy.coverage_drift is None and policy.resid_drift is None and policy.time_budget is None and \
+                quantile_regr not in ('online_RF', 'LR', 'KNN')
+            if parallel:
+                own_executor = executor is None
+                if own_executor:
+                    executor = ProcessPoolExecutor(max_workers=None if n_jobs == -1 else n_jobs,
+                                                   mp_context=multiprocessing.get_context('spawn'))
+                if num_chunks is None:
+                    num_chunks = (os.cpu_count() or 1) if n_jobs in (-1, 1) else n_jobs
+                chunk = period * max(1, math.ceil(num_unique_resid / (num_chunks * period)))
+                worker = copy.copy(self)
+                # Workers only need the QRF settings: leave out the data, the bootstrap ensemble and the residuals
+                worker.__dict__ = {k: v for k, v in self.__dict__.items()
+                                   if k in ('alpha', 'quantiles', 'quantile_idx') or
+                                   not isinstance(v, (np.ndarray, torch.Tensor, list, pd.DataFrame))}
+                resid = self.Ensemble_online_resid[len(self.X_train) - n1:-1]
+                futures = [executor.submit(_SPCI_chunk_task, worker, resid, n1, range(i, min(i+chunk, num_unique_resid)), s)
+                           for i in range(0, num_unique_resid, chunk)]
+                wid = []
+                for future in futures:
+                    wid_chunk, chunk_policy, self.QRF_ls, self.i_star_ls = future.result()
+                    wid.append(wid_chunk)
+                    policy.refit_idx += chunk_policy.refit_idx
+                    policy.refit_secs += chunk_policy.refit_secs
+                policy.wid_ls = chunk_policy.wid_ls
+                if own_executor:
+                    executor.shutdown()
+                wid = np.vstack(wid)
+            else:
+                wid = self.SPCI_widths(resid_strided, range(num_unique_resid), s)
+            width_left, width_right = curr_SigmaX * wid[:, 0], curr_SigmaX * wid[:, 1]
         print(
             f'Finish Computing {num_unique_resid} UNIQUE Prediction Intervals, took {time.time()-start} secs.')
         Ntest = len(out_sample_predict)
         # This is because |width|=T1/stride.
-        width_left = np.repeat(width_left, stride)[:Ntest]
+        width_left = np.repeat(width_left, stride, axis=0)[:Ntest]
         # This is because |width|=T1/stride.
-        width_right = np.repeat(width_right, stride)[:Ntest]
-        PIs_Ensemble = pd.DataFrame(np.c_[out_sample_predict + width_left,
-                                          out_sample_predict + width_right], columns=['lower', 'upper'])
+        width_right = np.repeat(width_right, stride, axis=0)[:Ntest]
+        if np.ndim(self.alpha) == 0:
+            PIs_Ensemble = pd.DataFrame(np.c_[out_sample_predict + width_left,
+                                              out_sample_predict + width_right], columns=['lower', 'upper'])
+        else:
+            center = out_sample_predict[:, None]
+            PIs_Ensemble = pd.DataFrame(np.stack([center + width_left, center + width_right], axis=2).reshape(Ntest, -1),
+                                        columns=pd.MultiIndex.from_product([self.alpha, ['lower', 'upper']],
+                                                                           names=['alpha', 'bound']))
         self.PIs_Ensemble = PIs_Ensemble
+        return PIs_Ensemble
     '''
         Get Multi-step QRF
     '''
@@ -368,56 +727,271 @@ class SPCI_and_EnbPI():
         # 1. Get "past_resid" into an auto-regressive fashion
         # This should be more carefully examined, b/c it depends on how long \hat{\eps}_t depends on the past
         # From practice, making it small make intervals wider
+        if self.T1 is not None and len(past_resid) > self.SPCI_history(n2, s):
+            # Bounded history: only the residuals of the last T1 training samples (a view, shifted to keep stream indices)
+            i += len(past_resid) - self.SPCI_history(n2, s)
+            past_resid = past_resid[-self.SPCI_history(n2, s):]
         num = len(past_resid)
-        resid_pred = past_resid[-n2:].reshape(1, -1)
-        residX = sliding_window_view(past_resid[:num-s+1], window_shape=n2)
-        for k in range(s):
-            residY = past_resid[n2+k:num-(s-k-1)]
-            self.train_QRF(residX, residY)
-            if i == 0:
+        residX = self.lag_features(past_resid[:num-s+1], n2, i)
+        resid_pred = self.lag_features(past_resid[-n2:], n2, i+num-n2)
+        self.quantiles, self.quantile_idx = self.QRF_quantiles()
+        if self.weigh_residuals:
+            # Built once here rather than by whichever horizon's thread gets there first
+            self.residual_weights()
+        # The s horizons are independent fits on the same (read-only) residX
+        residY_ls = [past_resid[n2+k:num-(s-k-1)] for k in range(s)]
+        cores = os.cpu_count() or 1
+        threads = min(s, cores) if self.QRF_threads is None else min(s, self.QRF_threads)
+        if threads > 1:
+            # The cores are split between the concurrent horizons rather than each forest asking for all of them
+            n_jobs = max(1, cores // threads)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                fits = list(executor.map(lambda k: self.fit_QRF(residX, residY_ls[k], i, k, resid_pred, n_jobs=n_jobs),
+                                         range(s)))
+        else:
+            fits = [self.fit_QRF(residX, residY_ls[k], i, k, resid_pred) for k in range(s)]
+        for k, (rfqr, i_star, leaf_dist) in enumerate(fits):
+            if len(self.QRF_ls) == k:
                 # Initial training, append QRF to QRF_ls
-                self.QRF_ls.append(self.rfqr)
-                self.i_star_ls.append(self.i_star)
+                self.QRF_ls.append(rfqr)
+                self.i_star_ls.append(i_star)
+                self.leaf_dist_ls.append((resid_pred.ravel().copy(), leaf_dist))
             else:
                 # Retraining, update QRF to QRF_ls
-                self.QRF_ls[k] = self.rfqr
-                self.i_star_ls[k] = self.i_star
+                self.QRF_ls[k] = rfqr
+                self.i_star_ls[k] = i_star
+                self.leaf_dist_ls[k] = (resid_pred.ravel().copy(), leaf_dist)
         return resid_pred
 
-    def train_QRF(self, residX, residY):
-        alpha = self.alpha
-        beta_ls = np.linspace(start=0, stop=alpha, num=self.bins)
-        full_alphas = np.append(beta_ls, 1 - alpha + beta_ls)
-        # Store quantiles for later use in predict()
-        self.quantiles = full_alphas
-
-        self.common_params = dict(n_estimators = self.n_estimators,
-                                  max_depth = self.max_d,
-                                  criterion = self.criterion,
-                                  n_jobs = -1)
+    def SPCI_history(self, n2, s):
+        '''
+            Number of past residuals the multi-step QRFs are trained from when self.T1 bounds the training samples:
+            T1 targets with s horizons, each behind n2 lags
+        '''
+        return self.T1 + n2 + s - 1
+
+    def SPCI_widths(self, resid_strided, rows, s):
+        '''
+            Unscaled SPCI widths (left, right) at the test indices in rows, a range whose first index is a QRF refit
+            Unless refits depend on the widths (coverage_drift), the features each set of QRFs serves are collected
+            until the next refit and predicted with one batched call per QRF.
+        '''
+        wid = np.zeros((len(rows), 2) + np.shape(self.alpha))
+        num_print = max(1, int(len(rows) / 20))
+        batched = self.refit_policy.coverage_drift is None
+        pending = []  # (j, remainder, features) still to be predicted by the current QRFs
+        for j, i in enumerate(rows):
+            remainder = i % s
+            if remainder == 0:
+                past_resid = resid_strided[i, :]
+                n2 = self.past_window
+                refit = self.refit_policy.should_refit(i, past_resid)
+                if refit:
+                    self.flush_QRF_widths(pending, wid, rows)
+                resid_pred = self.update_QRF(past_resid, i, s, n2, refit)
+            # Use the fitted regressor.
+            # NOTE, residX is NOT the same as before, as it depends on
+            # "past_resid", which has most entries replaced.
+            if batched:
+                # Copied, as featurizer caches may be reused
+                pending.append((j, remainder, np.array(resid_pred)))
+                continue
+            wid[j] = self.QRF_widths(remainder, resid_pred)
+            self.refit_policy.record(*wid[j])
+            if j % num_print == 0:
+                print(f'Width at test {i} is {wid[j, 1]-wid[j, 0]}')
+        self.flush_QRF_widths(pending, wid, rows)
+        return wid
+
+    def flush_QRF_widths(self, pending, wid, rows):
+        '''
+            Fill wid[j] for the (j, k, features) in pending with one QRF_widths_batch call per horizon k, then empty pending
+        '''
+        if not pending:
+            return
+        j_all, k_all, features = zip(*pending)
+        j_all, k_all, features = np.array(j_all), np.array(k_all), np.vstack(features)
+        for k in np.unique(k_all):
+            wid[j_all[k_all == k]] = self.QRF_widths_batch(k, features[k_all == k])
+        num_print = max(1, int(len(rows) / 20))
+        for j in j_all:
+            self.refit_policy.record(*wid[j])
+            if j % num_print == 0:
+                print(f'Width at test {rows[j]} is {wid[j, 1]-wid[j, 0]}')
+        pending.clear()
+
+    def update_QRF(self, past_resid, i, s, n2, refit=None):
+        '''
+            Refit the multi-step QRFs if self.refit_policy asks for it (or refit, if already decided), otherwise keep them
+            Either way, return the features of the most recent residuals to predict from
+        '''
+        if refit is None:
+            refit = self.refit_policy.should_refit(i, past_resid)
+        if refit:
+            start = time.time()
+            resid_pred = self.multi_step_QRF(past_resid, i, s, n2)
+            self.refit_policy.refitted(i, past_resid, time.time()-start)
+            return resid_pred
+        return self.lag_features(past_resid[-n2:], n2, i+len(past_resid)-n2)
+
+    def lag_features(self, past_resid, n2, i):
+        '''
+            QRF features of every length-n2 window of past_resid, whose first residual is number i of the residual stream
+            (the i-th test index shifts the window by i). Raw lags unless self.resid_featurizer is set.
+        '''
+        if self.resid_featurizer is None:
+            return sliding_window_view(past_resid, window_shape=n2)
+        return self.resid_featurizer.transform(past_resid, n2, i)
+
+    def QRF_widths(self, k, resid_pred):
+        '''
+            Lower and upper width of the k-th multi-step QRF at its \hat{\beta}, given features resid_pred
+            (arrays with one entry per alpha if self.alpha is a list)
+        '''
+        wid_left, wid_right = self.QRF_widths_batch(k, resid_pred.reshape(1, -1))[0]
+        return wid_left, wid_right
+
+    def QRF_widths_batch(self, k, features):
+        '''
+            QRF_widths of the k-th multi-step QRF at every row of features, in one predict call
+            Returns len(features)-by-2 (by len(alpha), for a list of alpha) widths
+        '''
+        rfqr = self.QRF_ls[k]
+        i_star = self.i_star_ls[k]
+        rows = np.arange(len(i_star))
+        # quantile-forest requires explicit quantiles parameter
+        if hasattr(rfqr, 'default_quantiles') and rfqr.default_quantiles is not None:
+            quantiles_list = np.append(self.quantiles[self.quantile_idx[rows, i_star]],
+                                       self.quantiles[self.quantile_idx[rows, self.bins+i_star]])
+            wid_all = np.zeros((len(features), len(quantiles_list)))
+            feature, leaf_dist = self.leaf_dist_ls[k]
+            cached = np.zeros(len(features), dtype=bool)
+            if leaf_dist is not None:
+                # Same query as when training: the cached leaf distribution already holds the answer
+                cached = (features == feature).all(1)
+                wid_all[cached] = leaf_dist.quantile(quantiles_list)
+            if not cached.all():
+                # quantile-forest returns shape (n_samples, n_quantiles)
+                wid_all[~cached] = rfqr.predict(features[~cached], quantiles=quantiles_list.tolist()).reshape(
+                    (~cached).sum(), -1)
+            wid_left, wid_right = wid_all[:, :len(rows)], wid_all[:, len(rows):]
+        else:
+            # Fallback for non-quantile regressors
+            wid_all = rfqr.predict(features).reshape(len(features), -1)
+            num_mid = int(wid_all.shape[1]/2)
+            wid_left, wid_right = wid_all[:, i_star], wid_all[:, num_mid+i_star]
+        wid = np.stack([wid_left, wid_right], axis=1)
+        if np.ndim(self.alpha) == 0:
+            return wid[:, :, 0]
+        return wid
+
+    def QRF_quantiles(self):
+        '''
+            Quantile levels every QRF is asked for: for each alpha, the lower ends beta_ls and upper ends 1-alpha+beta_ls of
+            the \beta search. Returns the sorted union of the levels, and the len(alpha)-by-2*bins positions of each alpha's
+            levels in it, so several alpha share one fit and one prediction.
+        '''
+        levels = []
+        for alpha in np.atleast_1d(self.alpha):
+            beta_ls = np.linspace(start=0, stop=alpha, num=self.bins)
+            levels.append(np.append(beta_ls, 1 - alpha + beta_ls))
+        quantiles, quantile_idx = np.unique(np.concatenate(levels), return_inverse=True)
+        return quantiles, quantile_idx.reshape(len(levels), -1)
+
+    def beta_star(self, low_high_pred):
+        '''
+            Index of \hat{\beta} in beta_ls for each alpha, given the predicted residual quantiles at self.quantiles
+        '''
+        low_high_pred = low_high_pred[self.quantile_idx]
+        return np.argmin(low_high_pred[:, self.bins:] - low_high_pred[:, :self.bins], axis=1)
+
+    def fit_QRF(self, residX, residY, i=0, k=0, resid_pred=None, n_jobs=-1):
+        '''
+            Fit the k-th step's quantile regressor on (residX[:-1], residY) and pick \hat{\beta} at residX[-1]
+            Returns (regressor, i_star per alpha, LeafDistribution at resid_pred or None), and only reads self.quantiles & the settings,
+            so that multi_step_QRF can run one per horizon in threads.
+            resid_pred: features the widths will be read at (default residX[-1]); its distribution is computed here so that
+                every horizon's widths come out of the (concurrent) fits instead of one forest pass each later
+            n_jobs: of the forest fit
+        '''
+        if self.quantile_regr in ('online_RF', 'LR', 'KNN'):
+            return self.train_online_QRF(residX, residY, i, k, resid_pred)
+
+        common_params = dict(n_estimators = self.n_estimators,
+                             max_depth = self.max_d,
+                             criterion = self.criterion,
+                             random_state = self.random_state,
+                             n_jobs = n_jobs)
         if residX[:-1].shape[0] > 10000:
             # see API ref. https://zillow.github.io/quantile-forest/
             # quantile-forest doesn't have a separate Sample version
             # The standard version is efficient for large datasets
-            self.rfqr = SampleRandomForestQuantileRegressor(
-                **self.common_params, default_quantiles=full_alphas)
+            rfqr = SampleRandomForestQuantileRegressor(
+                **common_params, default_quantiles=self.quantiles)
         else:
-            self.rfqr = RandomForestQuantileRegressor(
-                **self.common_params, default_quantiles=full_alphas)
+            rfqr = RandomForestQuantileRegressor(
+                **common_params, default_quantiles=self.quantiles)
         # 3. Find best \hat{\beta} via evaluating many quantiles
         # rfqr.fit(residX[:-1], residY)
+        if self.T1 is not None:
+            # Views, and a local bound rather than overwriting self.T1, which stays the same across calls
+            num_train = min(self.T1, len(residY))
+            residX, residY = residX[-(num_train+1):], residY[-num_train:]
         sample_weight = None
         if self.weigh_residuals:
-            sample_weight = self.c ** np.arange(len(residY), 0, -1)
-        if self.T1 is not None:
-            self.T1 = min(self.T1, len(residY)) # Sanity check to make sure no errors in training
-            self.i_star, _, _, _ = utils.binning_use_RF_quantile_regr(
-                self.rfqr, residX[-(self.T1+1):-1], residY[-self.T1:], residX[-1], beta_ls, sample_weight,
-                quantiles=self.quantiles)
+            # self.c ** np.arange(len(residY), 0, -1), as a view of the shared table
+            sample_weight = self.residual_weights().window(len(residY), newest_age=1)
+        # All alpha share the fit and the quantiles at residX[-1]
+        i_star, _, _, _, leaf_dist = utils.binning_use_RF_quantile_regr(
+            rfqr, residX[:-1], residY, residX[-1], None, sample_weight, quantiles=self.quantiles,
+            quantile_idx=self.quantile_idx, return_dist=True)
+        if leaf_dist is not None and resid_pred is not None and not np.array_equal(resid_pred.ravel(), residX[-1]):
+            leaf_dist = utils.leaf_distribution(rfqr, residY, resid_pred.ravel())
+        return rfqr, i_star, leaf_dist
+
+    def residual_weights(self):
+        '''
+            The utils.DecayWeights of self.c, kept across refits (and rebuilt if self.c changes)
+        '''
+        if self.decay_weights is None or self.decay_weights.c != self.c:
+            self.decay_weights = utils.DecayWeights(self.c)
+        return self.decay_weights
+
+    def train_online_QRF(self, residX, residY, i, k, resid_pred=None):
+        '''
+            Same as fit_QRF, but update the k-th step's quantile regressor with the samples that entered/left the window:
+            'online_RF': utils.OnlineQuantileForest, 'LR': utils.LinearQuantileRegressor (warm-started),
+            'KNN': utils.KNNQuantileRegressor
+        '''
+        # Row j of residY is sample i+j of the residual stream, as past_resid moves by one per test index
+        num_train = len(residY) if self.T1 is None else min(self.T1, len(residY))
+        ids = np.arange(i + len(residY) - num_train, i + len(residY))
+        decay = self.residual_weights() if self.weigh_residuals else None
+        if self.quantile_regr == 'LR':
+            regr_class, params = utils.LinearQuantileRegressor, dict(
+                default_quantiles=self.quantiles, decay=decay)
+        elif self.quantile_regr == 'KNN':
+            regr_class, params = utils.KNNQuantileRegressor, dict(
+                default_quantiles=self.quantiles, n_neighbors=self.n_neighbors, decay=decay)
         else:
-            self.i_star, _, _, _ = utils.binning_use_RF_quantile_regr(
-                self.rfqr, residX[:-1], residY, residX[-1], beta_ls, sample_weight,
-                quantiles=self.quantiles)
+            regr_class, params = utils.OnlineQuantileForest, dict(
+                n_estimators=self.n_estimators, max_depth=self.max_d, criterion=self.criterion,
+                random_state=self.random_state, default_quantiles=self.quantiles, decay=decay,
+                rebuild_every=num_train if self.online_RF_rebuild_every is None else self.online_RF_rebuild_every)
+        if len(self.QRF_ls) > k and isinstance(self.QRF_ls[k], regr_class):
+            rfqr = self.QRF_ls[k]
+        else:
+            rfqr = regr_class(**params)
+        rfqr.update(residX[:-1][-num_train:], residY[-num_train:], ids)
+        leaf_dist = None
+        if hasattr(rfqr, 'leaf_distribution'):
+            leaf_dist = rfqr.leaf_distribution(residX[-1])
+            low_high_pred = leaf_dist.quantile(self.quantiles)
+            if resid_pred is not None and not np.array_equal(resid_pred.ravel(), residX[-1]):
+                leaf_dist = rfqr.leaf_distribution(resid_pred.ravel())
+        else:
+            low_high_pred = rfqr.predict(residX[-1:], self.quantiles)[0]
+        return rfqr, self.beta_star(low_high_pred), leaf_dist
     '''
         All together
     '''
@@ -432,6 +1006,9 @@ class SPCI_and_EnbPI():
         train_size = len(self.X_train)
         if method == 'Ensemble':
             PI = self.PIs_Ensemble
+        if isinstance(PI.columns, pd.MultiIndex):
+            # Computed for several alpha at once
+            PI = PI[alpha]
         Ytest = self.Y_predict.cpu().detach().numpy()
         coverage = ((np.array(PI['lower']) <= Ytest) & (
             np.array(PI['upper']) >= Ytest)).mean()
@@ -446,6 +1023,125 @@ class SPCI_and_EnbPI():
         return results
 
 
+class SPCI_online_predictor():
+    '''
+        Streaming counterpart of SPCI_and_EnbPI.compute_PIs_Ensemble_online: one observation at a time,
+        with predict_interval(x_t) followed by update(y_t).
+        The last past_window (SPCI) or window (EnbPI) residuals live in a ring buffer of twice that length, where each residual
+        is written twice, so the window is always the contiguous view buffer[pos:pos+window] and nothing is reallocated per step.
+        SPCI refits the multi-step QRFs as compute_PIs_Ensemble_online does; EnbPI slides a SortedWindow.
+
+        SPCI_class: a SPCI_and_EnbPI after fit_bootstrap_models_online_multistep
+        center_func: optional callable x_t -> (\hat f(x_t), \hat \sigma(x_t)). If None, the center comes from the kept
+            bootstrap models at x_t (SPCI_class.predict_center). Without x_t, the cached ensemble prediction
+            (Ensemble_pred_interval_centers/sigma) of the next row of X_predict is used, which only exists for len(X_predict) steps.
+        refit_policy, quantile_regr: as in compute_PIs_Ensemble_online
+    '''
+
+    def __init__(self, SPCI_class, alpha, past_window=100, stride=1, use_SPCI=True, smallT=None, center_func=None,
+                 refit_policy=None, quantile_regr=None):
+        self.model = SPCI_class
+        alpha = alpha if np.ndim(alpha) == 0 else np.asarray(alpha, dtype=float)
+        self.alpha = alpha
+        self.stride = stride
+        self.use_SPCI = use_SPCI
+        self.center_func = center_func
+        smallT = not use_SPCI if smallT is None else smallT
+        n = len(SPCI_class.X_train)
+        # Same settings compute_PIs_Ensemble_online would store on the model
+        SPCI_class.alpha = alpha
+        SPCI_class.past_window = past_window
+        if quantile_regr is not None:
+            SPCI_class.quantile_regr = quantile_regr
+        SPCI_class.quantiles, SPCI_class.quantile_idx = SPCI_class.QRF_quantiles()
+        SPCI_class.QRF_ls = []
+        SPCI_class.i_star_ls = []
+        SPCI_class.leaf_dist_ls = []
+        if SPCI_class.resid_featurizer is not None:
+            SPCI_class.resid_featurizer.clear()
+        SPCI_class.refit_policy = utils.QRF_refit_policy() if refit_policy is None else refit_policy
+        SPCI_class.refit_policy.reset(alpha)
+        self.window = min(past_window, n) if smallT else n
+        if use_SPCI and SPCI_class.T1 is not None:
+            self.window = min(self.window, SPCI_class.SPCI_history(past_window, stride))
+        self.buffer = np.zeros(2 * self.window)
+        self.buffer[:self.window] = self.buffer[self.window:] = \
+            SPCI_class.Ensemble_online_resid[n-self.window:n]
+        self.pos = 0  # buffer[pos:pos+window] holds the window, oldest first
+        if not use_SPCI:
+            self.sorted_window = utils.SortedWindow(self.buffer[:self.window])
+        self.resid_pred = None  # allocated at the first QRF fit, once the number of features is known
+        self.t = 0  # number of observations seen so far
+        self.center, self.sigma = None, None
+        self.centers = None  # centers and sigmas of the multi-step bootstrap predictors at the features they predict from
+        self.width_left, self.width_right = 0., 0.
+
+    def past_resid(self):
+        return self.buffer[self.pos:self.pos+self.window]
+
+    def predict_interval(self, x_t=None):
+        '''
+            Return (lower, upper) for the next observation (arrays with one entry per alpha, for a list of alpha)
+        '''
+        if self.center_func is not None:
+            self.center, self.sigma = self.center_func(x_t)
+        else:
+            # With a multi-step fit, the s-th bootstrap predictor predicts s steps ahead of the last features every fit stride
+            fit_stride = len(self.model.test_weights_ls)
+            s = self.t % fit_stride
+            if s == 0:
+                self.centers = None if x_t is None else [
+                    self.model.predict_center(x_t, k) for k in range(fit_stride)]
+            if self.centers is not None:
+                self.center, self.sigma = (v[0] for v in self.centers[s])
+            elif self.t < len(self.model.X_predict):
+                self.center = self.model.Ensemble_pred_interval_centers[self.t]
+                self.sigma = self.model.Ensemble_pred_interval_sigma[self.t]
+            else:
+                raise ValueError(
+                    f'Step {self.t} is past the {len(self.model.X_predict)} rows of X_predict: pass x_t (or a center_func)')
+        i, remainder = divmod(self.t, self.stride)
+        if self.use_SPCI:
+            if remainder == 0:
+                # Copy out of the ring buffer, as the features stay fixed for the next stride steps
+                resid_pred = self.model.update_QRF(
+                    self.past_resid(), self.t, self.stride, self.model.past_window)
+                if self.resid_pred is None:
+                    self.resid_pred = resid_pred.copy()
+                else:
+                    self.resid_pred[:] = resid_pred
+            wid_left, wid_right = self.model.QRF_widths(
+                remainder, self.resid_pred)
+            self.model.refit_policy.record(wid_left, wid_right)
+            self.width_left, self.width_right = self.sigma * wid_left, self.sigma * wid_right
+        elif remainder == 0:
+            # Widths are shared by the stride steps that follow, as in compute_PIs_Ensemble_online
+            alphas = np.atleast_1d(self.alpha)
+            beta_hat_bin, width_left, width_right = np.zeros((3, len(alphas)))
+            for j, a in enumerate(alphas):
+                # As binning_sliding, one binning per alpha on the same sorted window
+                beta_hat_bin[j] = utils.binning(self.sorted_window, a)
+                width_left[j] = self.sorted_window.percentile(math.ceil(100 * beta_hat_bin[j]))
+                width_right[j] = self.sorted_window.percentile(math.ceil(100 * (1 - a + beta_hat_bin[j])))
+            if np.ndim(self.alpha) == 0:
+                beta_hat_bin, width_left, width_right = beta_hat_bin[0], width_left[0], width_right[0]
+            self.model.beta_hat_bins.append(beta_hat_bin)
+            self.width_left, self.width_right = self.sigma * width_left, self.sigma * width_right
+        return self.center + self.width_left, self.center + self.width_right
+
+    def update(self, y_t):
+        '''
+            Observe y_t for the point last passed to predict_interval, and push its residual into the window
+        '''
+        resid = (float(y_t) - self.center) / self.sigma
+        if not self.use_SPCI:
+            self.sorted_window.evict(self.buffer[self.pos])
+            self.sorted_window.insert(resid)
+        self.buffer[self.pos] = self.buffer[self.pos+self.window] = resid
+        self.pos = (self.pos + 1) % self.window
+        self.t += 1
+
+
 class MLP(nn.Module):
     def __init__(self, d, sigma=False):
         super(MLP, self).__init__()
@@ -462,6 +1158,87 @@ class MLP(nn.Module):
         return self.layers(x) + perturb
 
 
+class BatchedMLP(nn.Module):
+    '''
+        B independent copies of MLP above, stored as stacked weights so that all members train in one forward/backward pass.
+        Input: B-by-m-by-d, output: B-by-m
+    '''
+
+    def __init__(self, d, B, sigma=False):
+        super(BatchedMLP, self).__init__()
+        H = 64
+        self.sigma = sigma
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for fan_in, fan_out in [(d, H), (H, H), (H, 1)]:
+            # Same U(-1/sqrt(fan_in), 1/sqrt(fan_in)) initialization as nn.Linear
+            bound = 1 / math.sqrt(fan_in)
+            self.weights.append(nn.Parameter(
+                torch.empty(B, fan_in, fan_out).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(
+                torch.empty(B, 1, fan_out).uniform_(-bound, bound)))
+
+    def forward(self, x):
+        num_layers = len(self.weights)
+        for l, (W, b) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(b, x, W)
+            if l < num_layers - 1 or self.sigma:
+                x = torch.relu(x)
+        perturb = 1e-3 if self.sigma else 0
+        return x.squeeze(-1) + perturb
+
+
+class BootstrapModels():
+    '''
+        The B fitted f^b (and \sigma^b) of one multi-step predictor, kept to predict at features seen after fitting
+        blocks: list of (kind, model_f, model_sigma), each standing for one or more consecutive f^b:
+            'MLP' one MLP (model_sigma None if not fit_sigmaX), 'batched_MLP' a BatchedMLP, 'sklearn' one fitted regressor,
+            'linear' the B-by-p coefficients of batched_linear_boot_predictions (model_sigma = fit_intercept),
+            'forest' the bagged forest of the OOB mode
+        members: b -> block of a single f^b refit later (append_training), replacing the b-th row
+    '''
+
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.members = {}
+
+    def __add__(self, other):
+        # f^b of a later batch (fit_bootstrap_models_anytime) come after those of self
+        return BootstrapModels(self.blocks + other.blocks)
+
+    def predict(self, X):
+        '''
+            B-by-len(X) predictions of the f^b and \sigma^b (all ones without \sigma^b) at the rows of the tensor X
+        '''
+        preds = [self.predict_block(block, X) for block in self.blocks]
+        fX, sigmaX = np.vstack([p[0] for p in preds]), np.vstack([p[1] for p in preds])
+        for b, block in self.members.items():
+            fX[b], sigmaX[b] = self.predict_block(block, X)
+        return fX, sigmaX
+
+    @staticmethod
+    def predict_block(block, X):
+        kind, model_f, model_sigma = block
+        if kind in ('MLP', 'batched_MLP'):
+            if kind == 'batched_MLP':
+                X = X.unsqueeze(0).expand(model_f.weights[0].shape[0], -1, -1)
+            with torch.no_grad():
+                fX = detach_torch(model_f(X)).reshape(-1, X.shape[-2])
+                sigmaX = np.ones_like(fX) if model_sigma is None else detach_torch(
+                    model_sigma(X)).reshape(-1, X.shape[-2])
+            return fX, sigmaX
+        X = detach_torch(X)
+        if kind == 'linear':
+            if model_sigma:
+                X = np.c_[np.ones(len(X)), X]
+            fX = model_f.dot(X.T)
+        elif kind == 'forest':
+            fX = np.vstack([tree.predict(X) for tree in model_f.estimators_])
+        else:
+            fX = model_f.predict(X).reshape(1, -1)
+        return fX, np.ones_like(fX)
+
+
 #### Competing Methods ####
 
 
@@ -11,6 +11,8 @@ import numpy as np
 import math
 from scipy.sparse import random
 from . import PI_class_EnbPI as EnbPI  # For me
+from .utils_SPCI import (SortedWindow, binning, binning_sliding, binning_strided, forest_OOB_predictions,
+                         generate_bootstrap_samples)
 import matplotlib.cm as cm
 # from keras.layers import LSTM, Dense, Dropout
 # from keras.models import Sequential
@@ -474,30 +476,6 @@ def read_wind_data():
     return data_wind_19
 
 
-'''Binning Subroutine (used everywhere)'''
-
-
-def binning(past_resid, alpha):
-    '''
-    Input:
-        past residuals: evident
-        alpha: signifance level
-    Output:
-        beta_hat_bin as argmin of the difference
-    Description:
-        Compute the beta^hat_bin from past_resid, by breaking [0,alpha] into bins (like 20). It is enough for small alpha
-        number of bins are determined rather automatic, relative the size of whole domain
-    '''
-    bins = 5  # For computation, can just reduce it to like 10 or 5 in real data
-    beta_is = np.linspace(start=0, stop=alpha, num=bins)
-    width = np.zeros(bins)
-    for i in range(bins):
-        width[i] = np.percentile(past_resid, math.ceil(100 * (1 - alpha + beta_is[i]))) - \
-            np.percentile(past_resid, math.ceil(100 * beta_is[i]))
-    i_star = np.argmin(width)
-    return beta_is[i_star]
-
-
 '''Neural Networks Regressors'''
 
 
@@ -528,15 +506,26 @@ def keras_rnn():
 '''Helper for ensemble'''
 
 
-def generate_bootstrap_samples(n, m, B):
+def ridge_jackknife(X_train, Y_train, X_predict, alpha=0, fit_intercept=True):
     '''
-      Return: B-by-m matrix, where row b gives the indices for b-th bootstrap sample
+      Exact leave-one-out quantities of ridge regression (alpha=0 is least squares), with an unpenalized intercept
+      Return:
+        resid_LOO: length n, Y_i - mu_{-i}(X_i) = e_i/(1-h_ii)
+        pred_LOO_mean: length n1, (1/n) sum_i mu_{-i}(X_predict), since beta_{-i} = beta - G^{-1}X_i e_i/(1-h_ii)
     '''
-    samples_idx = np.zeros((B, m), dtype=int)
-    for b in range(B):
-        sample_idx = np.random.choice(n, m)
-        samples_idx[b, :] = sample_idx
-    return(samples_idx)
+    n = len(X_train)
+    if fit_intercept:
+        X_train = np.c_[np.ones(n), X_train]
+        X_predict = np.c_[np.ones(len(X_predict)), X_predict]
+    penalty = alpha * np.eye(X_train.shape[1])
+    if fit_intercept:
+        penalty[0, 0] = 0
+    G_inv = np.linalg.pinv(X_train.T.dot(X_train) + penalty)
+    beta = G_inv.dot(X_train.T.dot(Y_train))
+    h = np.einsum('ij,jk,ik->i', X_train, G_inv, X_train)
+    resid_LOO = (Y_train - X_train.dot(beta)) / (1 - h)
+    beta_LOO_mean = beta - G_inv.dot(X_train.T.dot(resid_LOO)) / n
+    return resid_LOO, X_predict.dot(beta_LOO_mean)
 
 
 def one_dimen_transform(Y_train, Y_predict, d):
@@ -1417,7 +1406,10 @@ def big_transform_s_beyond_1(sub, cities, current_city, one_dim, missing, miss_f
     return([X_train, X_predict, Y_train, Y_predict, true_miss_text_idx, stride])
 
 
-def all_together(Data_name, sub, no_slide, missing, miss_frac=0.25, one_dim=False, use_EnbPI=True):
+def all_together(Data_name, sub, no_slide, missing, miss_frac=0.25, one_dim=False, use_EnbPI=True, ridge_jackknife=False):
+    '''
+        ridge_jackknife: if True, the RidgeCV residuals come from the exact jackknife+ (no bootstrap refits) instead of B bootstrap models
+    '''
     methods = ['Ensemble'] if use_EnbPI else ['QOOB', 'Adaptive_CI']
     train_days = 92
     itrial = 1
@@ -1453,7 +1445,10 @@ def all_together(Data_name, sub, no_slide, missing, miss_frac=0.25, one_dim=Fals
                                                   bootstrap=False, max_depth=2, n_jobs=-1)
             ridge_results = EnbPI.prediction_interval(
                 ridge_cv,  X_train, X_predict, Y_train, Y_predict)
-            ridge_results.fit_bootstrap_models_online(B, miss_test_idx)
+            if ridge_jackknife:
+                ridge_results.fit_ridge_jackknife_online(miss_test_idx)
+            else:
+                ridge_results.fit_bootstrap_models_online(B, miss_test_idx)
             rf_results = EnbPI.prediction_interval(
                 random_forest,  X_train, X_predict, Y_train, Y_predict)
             rf_results.fit_bootstrap_models_online(B, miss_test_idx)
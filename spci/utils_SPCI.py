@@ -2,7 +2,12 @@
 # from sklearn.linear_model import QuantileRegressor
 import numpy as np
 import math
+import bisect
+import itertools
+from scipy import stats
+from sklearn.ensemble import RandomForestRegressor
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 #### From utils_EnbPI ####
@@ -57,27 +62,201 @@ def make_NP_df(X, Y):
     return df_tmp, Xnames
 
 
-def generate_bootstrap_samples(n, m, B):
+def generate_bootstrap_samples(n, m, B, seed=None, replace=True, return_counts=False):
     '''
       Return: B-by-m matrix, where row b gives the indices for b-th bootstrap sample
+        seed: None draws from the global np.random state. Otherwise an int or np.random.SeedSequence, from which
+          the b-th sample gets its own child stream, so row b does not depend on B or on the order models are fitted in
+        replace: if False, draw m-out-of-n subsamples without replacement (needs m <= n)
+        return_counts: if True, also return the B-by-n bootstrap counts (see bootstrap_counts)
     '''
-    samples_idx = np.zeros((B, m), dtype=int)
-    for b in range(B):
-        sample_idx = np.random.choice(n, m)
-        samples_idx[b, :] = sample_idx
+    if seed is None:
+        samples_idx = np.zeros((B, m), dtype=int)
+        for b in range(B):
+            sample_idx = np.random.choice(n, m, replace=replace)
+            samples_idx[b, :] = sample_idx
+    else:
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        samples_idx = np.zeros(
+            (B, m), dtype=np.int32 if n < 2**31 else np.int64)
+        for b, child in enumerate(seed.spawn(B)):
+            rng = np.random.default_rng(child)
+            if replace:
+                samples_idx[b] = rng.integers(0, n, m)
+            else:
+                samples_idx[b] = rng.choice(n, m, replace=False)
+    if return_counts:
+        return samples_idx, bootstrap_counts(samples_idx, n)
     return(samples_idx)
 
 
+def bootstrap_counts(samples_idx, n, weights=None):
+    '''
+      Return: B-by-n matrix, where entry (b, i) counts how often index i appears in the b-th bootstrap sample
+        weights: optional length-m vector, adding weights[k] (rather than 1) for the k-th draw of every sample
+    '''
+    B, m = samples_idx.shape
+    flat_idx = (samples_idx + n * np.arange(B)[:, None]).ravel()
+    if weights is not None:
+        weights = np.tile(weights, B)
+    return np.bincount(flat_idx, weights=weights, minlength=B * n).reshape(B, n)
+
+
+def batched_linear_boot_predictions(Xtrain, Ytrain, Xfull, sample_weight, alpha=0, fit_intercept=True, return_coef=False):
+    '''
+      Solve the B weighted least-squares (alpha=0) or ridge problems of the bootstrap models at once via normal equations
+        sample_weight: B-by-n, row b are the bootstrap counts of f^b (times any WLS weights)
+        The intercept is not penalized, as in sklearn's Ridge
+        return_coef: if True, also return the B-by-p coefficients (intercept first, if fit_intercept)
+      Return: B-by-len(Xfull) matrix of predictions
+    '''
+    if fit_intercept:
+        Xtrain = np.c_[np.ones(len(Xtrain)), Xtrain]
+        Xfull = np.c_[np.ones(len(Xfull)), Xfull]
+    penalty = alpha * np.eye(Xtrain.shape[1])
+    if fit_intercept:
+        penalty[0, 0] = 0
+    # Contracted without forming the B-by-n-by-p weighted design
+    XtWX = np.einsum('bn,np,nq->bpq', sample_weight, Xtrain, Xtrain) + penalty
+    XtWY = sample_weight @ (Xtrain * Ytrain[:, None])
+    try:
+        coef = np.linalg.solve(XtWX, XtWY[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        # Some bootstrap sample is rank deficient, fall back to the minimum-norm solution
+        coef = np.matmul(np.linalg.pinv(XtWX), XtWY[:, :, None])[:, :, 0]
+    if return_coef:
+        return coef.dot(Xfull.T), coef
+    return coef.dot(Xfull.T)
+
+
+def forest_OOB_predictions(forest, Xtrain, Ytrain, Xfull):
+    '''
+      Fit ONE bagged forest and use its trees as the B = forest.n_estimators bootstrap models
+      Return: in_boot_sample (B-by-n, from the per-tree sample indices) and boot_predictions (B-by-len(Xfull), per-tree predict)
+    '''
+    forest.fit(Xtrain, Ytrain)
+    in_boot_sample = np.zeros((len(forest.estimators_), len(Xtrain)), dtype=bool)
+    for b, sample_idx in enumerate(forest.estimators_samples_):
+        in_boot_sample[b, sample_idx] = True
+    boot_predictions = np.vstack([tree.predict(Xfull)
+                                 for tree in forest.estimators_])
+    return in_boot_sample, boot_predictions
+
+
+def LOO_weights(in_boot_sample, idx, available=None):
+    '''
+      Return: B-by-len(idx) matrix, where column j averages the f^b that did NOT use idx[j] in training
+        Indices not used by any f^b (idx[j] >= in_boot_sample.shape[1]) average all B models.
+        If every f^b used idx[j], fall back to the first model only.
+        available: optional B-by-len(idx) mask of which f^b have a prediction at idx[j]; the others get zero weight
+          (and the fallback is then the first available model)
+    '''
+    B, N = in_boot_sample.shape
+    W = np.full((B, len(idx)), 1 / B)
+    in_train = idx < N
+    b_keep = ~in_boot_sample[:, idx[in_train]]
+    first = np.zeros(b_keep.shape, dtype=bool)
+    first[0] = True
+    if available is not None:
+        b_keep &= available[:, in_train]
+        first = available[:, in_train] & (
+            np.cumsum(available[:, in_train], axis=0) == 1)
+    num_keep = b_keep.sum(0)
+    b_keep[:, num_keep == 0] = first[:, num_keep == 0]
+    W[:, in_train] = b_keep / np.maximum(b_keep.sum(0), 1)
+    return W
+
+
 def strided_app(a, L, S):  # Window len = L, Stride len/stepsize = S
     nrows = ((a.size - L) // S) + 1
     n = a.strides[0]
     return np.lib.stride_tricks.as_strided(a, shape=(nrows, L), strides=(S * n, n))
 
 
+class SortedWindow():
+    '''
+        Multiset of the residuals in a sliding window, kept sorted in blocks of at most 2*load values
+        insert/evict cost O(log w + load) and kth/percentile cost O(log w), instead of O(w log w) to re-sort the window
+        percentile matches np.percentile (method='linear') on the same values
+    '''
+
+    def __init__(self, values=(), load=256):
+        self.load = load
+        values = sorted(values)
+        self.blocks = [values[i:i+load] for i in range(0, len(values), load)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self._cumlen = None  # cumulative block lengths, rebuilt lazily after a change
+        self.size = len(values)
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, value):
+        self._cumlen = None
+        self.size += 1
+        if not self.blocks:
+            self.blocks.append([value])
+            self.maxes.append(value)
+            return
+        j = min(bisect.bisect_left(self.maxes, value), len(self.blocks) - 1)
+        block = self.blocks[j]
+        bisect.insort(block, value)
+        self.maxes[j] = block[-1]
+        if len(block) > 2 * self.load:
+            # Split in halves so that blocks stay short
+            self.blocks[j:j+1] = [block[:self.load], block[self.load:]]
+            self.maxes[j:j+1] = [block[self.load-1], block[-1]]
+
+    def evict(self, value):
+        j = bisect.bisect_left(self.maxes, value)
+        if j == len(self.blocks):
+            raise ValueError(f'{value} is not in the window')
+        block = self.blocks[j]
+        k = bisect.bisect_left(block, value)
+        if block[k] != value:
+            raise ValueError(f'{value} is not in the window')
+        self._cumlen = None
+        self.size -= 1
+        del block[k]
+        if block:
+            self.maxes[j] = block[-1]
+        else:
+            del self.blocks[j], self.maxes[j]
+
+    def kth(self, k):
+        '''k-th smallest value, 0-indexed'''
+        if self._cumlen is None:
+            self._cumlen = list(itertools.accumulate(len(block)
+                                for block in self.blocks))
+        j = bisect.bisect_right(self._cumlen, k)
+        return self.blocks[j][k - (self._cumlen[j-1] if j > 0 else 0)]
+
+    def percentile(self, q):
+        # Same floating-point steps as numpy's 'linear' method, so results are identical
+        n = self.size
+        quantile = np.true_divide(q, 100)
+        virtual_index = (n - 1) * quantile
+        previous_index = int(np.floor(virtual_index))
+        gamma = virtual_index - previous_index
+        a = self.kth(previous_index)
+        b = self.kth(min(previous_index + 1, n - 1))
+        diff_b_a = b - a
+        if gamma >= 0.5:
+            return b - diff_b_a * (1 - gamma)
+        return a + diff_b_a * gamma
+
+
+def _percentile(past_resid, q):
+    if isinstance(past_resid, SortedWindow):
+        return past_resid.percentile(q)
+    return np.percentile(past_resid, q)
+
+
 def binning(past_resid, alpha):
     '''
     Input:
-        past residuals: evident
+        past residuals: evident, either an array or a SortedWindow
         alpha: signifance level
     Output:
         beta_hat_bin as argmin of the difference
@@ -89,15 +268,675 @@ def binning(past_resid, alpha):
     beta_ls = np.linspace(start=0, stop=alpha, num=bins)
     width = np.zeros(bins)
     for i in range(bins):
-        width[i] = np.percentile(past_resid, math.ceil(100 * (1 - alpha + beta_ls[i]))) - \
-            np.percentile(past_resid, math.ceil(100 * beta_ls[i]))
+        width[i] = _percentile(past_resid, math.ceil(100 * (1 - alpha + beta_ls[i]))) - \
+            _percentile(past_resid, math.ceil(100 * beta_ls[i]))
     i_star = np.argmin(width)
     return beta_ls[i_star]
 
 
-def binning_use_RF_quantile_regr(quantile_regr, Xtrain, Ytrain, feature, beta_ls, sample_weight=None, quantiles=None):
+def binning_strided(resid_strided, alpha, bins=5, max_elements=2**24):
+    '''
+    Input:
+        resid_strided: num_windows-by-w matrix, where each row is a window of past residuals
+        alpha: signifance level, or a list of them
+        max_elements: bound on the number of entries of resid_strided partitioned at once
+    Output:
+        beta_hat_bins, width_left, width_right: one per window, identical to calling binning on each row
+            and then taking the two percentiles at beta_hat_bin. For a list of alpha, num_windows-by-len(alpha) arrays.
+    Description:
+        All percentiles needed by every beta candidate (of every alpha) are taken in one axis-wise np.percentile call per chunk of rows
+    '''
+    alphas = np.atleast_1d(alpha)
+    beta_ls = np.array([np.linspace(start=0, stop=a, num=bins) for a in alphas])
+    # Same (integer) percentile levels as binning, many of which coincide across beta and alpha
+    q_low = [math.ceil(100 * beta) for beta in beta_ls.ravel()]
+    q_high = [math.ceil(100 * (1 - a + beta)) for a, betas in zip(alphas, beta_ls) for beta in betas]
+    q_all, q_inv = np.unique(q_low + q_high, return_inverse=True)
+    q_inv = q_inv.reshape(2, len(alphas), bins)
+    num_windows, w = resid_strided.shape
+    chunk = max(1, max_elements // max(w, 1))
+    beta_hat_bins = np.zeros((num_windows, len(alphas)))
+    width_left = np.zeros((num_windows, len(alphas)))
+    width_right = np.zeros((num_windows, len(alphas)))
+    for start in range(0, num_windows, chunk):
+        rows = slice(start, start + chunk)
+        perc = np.percentile(resid_strided[rows], q_all, axis=1)  # len(q_all)-by-chunk
+        for j in range(len(alphas)):
+            low, high = perc[q_inv[0, j]], perc[q_inv[1, j]]  # bins-by-chunk
+            i_star = np.argmin(high - low, axis=0)
+            cols = np.arange(len(i_star))
+            beta_hat_bins[rows, j] = beta_ls[j, i_star]
+            width_left[rows, j] = low[i_star, cols]
+            width_right[rows, j] = high[i_star, cols]
+    if np.ndim(alpha) == 0:
+        return beta_hat_bins[:, 0], width_left[:, 0], width_right[:, 0]
+    return beta_hat_bins, width_left, width_right
+
+
+def binning_sliding(resid, w, alpha, stride=1):
+    '''
+    Input:
+        resid: 1-D array of residuals, whose windows of length w every stride steps are the rows of strided_app(resid, w, stride)
+    Output:
+        Same as binning_strided(strided_app(resid, w, stride), alpha)
+    Description:
+        Slides ONE SortedWindow along resid, so each step costs O(stride * log w) rather than O(w).
+        Preferable to binning_strided for long windows (w of 10^4 and more).
+    '''
+    resid = np.asarray(resid, dtype=float).tolist()  # Python floats bisect much faster than numpy scalars
+    alphas = np.atleast_1d(alpha)
+    num_windows = (len(resid) - w) // stride + 1
+    window = SortedWindow(resid[:w])
+    beta_hat_bins = np.zeros((num_windows, len(alphas)))
+    width_left = np.zeros((num_windows, len(alphas)))
+    width_right = np.zeros((num_windows, len(alphas)))
+    for i in range(num_windows):
+        if i > 0:
+            for j in range((i-1)*stride, i*stride):
+                window.evict(resid[j])
+                window.insert(resid[j+w])
+        for j, a in enumerate(alphas):
+            beta_hat_bins[i, j] = binning(window, a)
+            width_left[i, j] = window.percentile(math.ceil(100 * beta_hat_bins[i, j]))
+            width_right[i, j] = window.percentile(
+                math.ceil(100 * (1 - a + beta_hat_bins[i, j])))
+    if np.ndim(alpha) == 0:
+        return beta_hat_bins[:, 0], width_left[:, 0], width_right[:, 0]
+    return beta_hat_bins, width_left, width_right
+
+
+class DecayWeights():
+    '''
+        Exponential weights c**age of samples by their age (0 = newest), read off ONE table of c**0, c**1, ... that grows by
+        doubling, so the weights of every window are a (reversed) view or a gather instead of a fresh power per sample.
+        As weights only depend on age, the table is shared by every refit, horizon and window length (e.g. a bounded history).
+    '''
+
+    def __init__(self, c):
+        self.c = c
+        self.powers = np.ones(1)
+
+    def _table(self, n):
+        # Readers keep their own reference, so concurrent fits never see a shorter table than they asked for
+        powers = self.powers
+        if len(powers) < n:
+            powers = self.c ** np.arange(max(n, 2 * len(powers)), dtype=float)
+            if len(powers) > len(self.powers):
+                self.powers = powers
+        return powers
+
+    def window(self, n, newest_age=0):
+        '''Weights of n consecutive samples, oldest first, whose newest one has age newest_age'''
+        return self._table(newest_age + n)[newest_age:newest_age+n][::-1]
+
+    def ages(self, age):
+        '''Weights of samples of the given ages (any integer array)'''
+        age = np.asarray(age, dtype=int)
+        return self._table(age.max() + 1 if age.size else 0)[age]
+
+
+def as_decay_weights(decay):
+    '''None, or decay as a DecayWeights (a float c gets its own table)'''
+    if decay is None or isinstance(decay, DecayWeights):
+        return decay
+    return DecayWeights(decay)
+
+
+class LeafDistribution():
+    '''
+        Weighted empirical distribution of the training responses that share leaves with one query point
+        Once built, any number of quantiles cost one searchsorted, so dense beta grids are as cheap as coarse ones.
+        interpolation: 'linear' treats weights as frequencies and interpolates as np.quantile on the repeated values
+            (the rule of quantile-forest's predict); 'inverted_cdf' returns the first value whose cumulative weight reaches q
+    '''
+
+    def __init__(self, values, weights, interpolation='linear'):
+        order = np.argsort(values, kind='stable')
+        self.values = np.asarray(values, dtype=float)[order]
+        self.cum_weights = np.cumsum(np.asarray(weights, dtype=float)[order])
+        self.interpolation = interpolation
+
+    def quantile(self, quantiles):
+        quantiles = np.asarray(quantiles, dtype=float)
+        total, last = self.cum_weights[-1], len(self.values) - 1
+        if self.interpolation == 'inverted_cdf':
+            k = np.searchsorted(self.cum_weights, quantiles * total)
+            return self.values[np.minimum(k, last)]
+        # The value at rank r of the repeated values is the first one whose cumulative weight exceeds r
+        virtual_index = (total - 1) * quantiles
+        previous_index = np.floor(virtual_index)
+        gamma = virtual_index - previous_index
+        a = self.values[np.minimum(np.searchsorted(
+            self.cum_weights, previous_index, side='right'), last)]
+        b = self.values[np.minimum(np.searchsorted(
+            self.cum_weights, previous_index + 1, side='right'), last)]
+        diff_b_a = b - a
+        return np.where(gamma >= 0.5, b - diff_b_a * (1 - gamma), a + diff_b_a * gamma)
+
+
+class LeafMixture():
+    '''
+        Equal mixture of the weighted distributions of several sorted leaves, without merging them
+        values_ls[t]: sorted responses of leaf t; cum_weights_ls[t]: their cumulative (unnormalized) weights
+        quantile is the 'inverted_cdf' rule of LeafDistribution on the pooled, per-leaf normalized samples, found by a
+        binary search in every leaf at once, so it costs O(log(leaf size)) searches rather than a pass over the samples.
+    '''
+
+    def __init__(self, values_ls, cum_weights_ls):
+        self.values_ls = values_ls
+        self.cum_weights_ls = cum_weights_ls
+
+    def cdf(self, v):
+        '''Summed normalized weight of the samples <= v in each leaf'''
+        F = np.zeros(np.shape(v))
+        for vals, cum in zip(self.values_ls, self.cum_weights_ls):
+            pos = np.searchsorted(vals, v, side='right')
+            F += np.where(pos > 0, cum[np.maximum(pos - 1, 0)], 0) / cum[-1]
+        return F
+
+    def quantile(self, quantiles):
+        targets = np.asarray(quantiles, dtype=float) * len(self.values_ls)
+        T = len(self.values_ls)
+        sizes = np.array([len(vals) for vals in self.values_ls])[:, None]
+        # lo/hi bracket, in every leaf, the first sample whose pooled cdf reaches each target
+        lo = np.zeros((T, len(targets)), dtype=int)
+        hi = np.repeat(sizes, len(targets), axis=1)
+        while (lo < hi).any():
+            mid = (lo + hi) // 2
+            cand = np.array([vals[np.minimum(m, len(vals) - 1)] for vals, m in zip(self.values_ls, mid)])
+            reached = self.cdf(cand) >= targets
+            active = lo < hi
+            hi = np.where(active & reached, mid, hi)
+            lo = np.where(active & ~reached, mid + 1, lo)
+        cand = np.array([np.append(vals, np.inf)[m] for vals, m in zip(self.values_ls, lo)])
+        found = cand.min(0)
+        # Targets beyond the total weight (rounding at q=1) take the largest sample, as LeafDistribution
+        return np.where(np.isfinite(found), found, max(vals[-1] for vals in self.values_ls))
+
+
+def leaf_distribution(quantile_regr, Ytrain, feature):
+    '''
+        LeafDistribution of a fitted quantile-forest (or OnlineQuantileForest) at ONE feature vector
+        Ytrain: the responses the forest was fit on
+    '''
+    if isinstance(quantile_regr, OnlineQuantileForest):
+        return quantile_regr.leaf_distribution(feature)
+    # Each count is how often a training sample shares a leaf with feature, which is its weight in predict()
+    proximities = quantile_regr.proximity_counts(feature.reshape(1, -1))[0]
+    idx, counts = zip(*proximities)
+    return LeafDistribution(np.asarray(Ytrain)[list(idx)], counts)
+
+
+class OnlineQuantileForest():
+    '''
+        Quantile regression forest over a sliding window of samples, updated instead of refit
+        The tree structures come from ONE RandomForestRegressor fit (redone every rebuild_every insertions, if given).
+        Afterwards each leaf keeps its samples sorted by response, keyed by a global sample index, with the cumulative
+        weights along that order, so that insert/evict only route one sample through the trees and quantiles only binary
+        search the leaves the query falls in (LeafMixture).
+        A leaf is a set of flat arrays, so insert/evict still shift the part of each leaf after the sample (np.insert/np.delete
+        and the cumulative weights): a memmove linear in the leaf size, about window / 2**max_depth per tree. There is no
+        Python-level pass over the window, which keeps a step cheap in practice, but it is not sublinear in the window.
+        decay: if given, sample j has weight decay**(newest index - j) within its leaf (as SPCI's weigh_residuals),
+            either the float decay or a DecayWeights. Within a leaf only ratios matter, so the stored weights are
+            1 / decay**(j - ref), read off the DecayWeights table, for a reference index ref that moves to the oldest
+            sample (recomputing the weights) once the table would have to grow past twice the window or overflow.
+        Same predict(X, quantiles) interface as quantile-forest's RandomForestQuantileRegressor.
+    '''
+
+    def __init__(self, n_estimators=10, max_depth=2, criterion='squared_error', random_state=None,
+                 default_quantiles=None, decay=None, rebuild_every=None):
+        self.n_estimators = n_estimators
+        self.max_depth = max_depth
+        self.criterion = criterion
+        self.random_state = random_state
+        self.default_quantiles = default_quantiles
+        self.decay = decay
+        self.decay_weights = as_decay_weights(decay)
+        self.rebuild_every = rebuild_every
+        self.forest = None
+        self.samples = {}  # global index -> (y, leaf of each tree)
+
+    def _apply(self, X):
+        # forest.apply without its per-call validation and joblib dispatch, which dominate for a single sample
+        X = np.ascontiguousarray(X, dtype=np.float32).reshape(-1, self.forest.n_features_in_)
+        return np.column_stack([tree.tree_.apply(X) for tree in self.forest.estimators_])
+
+    def _weights(self, ids):
+        ids = np.asarray(ids)
+        return np.ones(len(ids)) if self.decay is None else 1 / self.decay_weights.ages(ids - self.ref)
+
+    def fit(self, X, y, ids=None):
+        '''
+            Build the tree structures from (X, y) and fill the leaves with them
+            ids: contiguous increasing global indices of the samples
+        '''
+        ids = np.arange(len(y)) if ids is None else np.asarray(ids)
+        y = np.asarray(y, dtype=float)
+        self.forest = RandomForestRegressor(n_estimators=self.n_estimators, max_depth=self.max_depth,
+                                            criterion=self.criterion, random_state=self.random_state)
+        self.forest.fit(X, y)
+        leaf_ids = self.forest.apply(X)
+        self.first, self.last, self.ref = int(ids[0]), int(ids[-1]), int(ids[0])
+        # leaves[t][leaf] = [sorted responses, their global indices, weights, cumulative weights];
+        # ties stay in index order, as for insert
+        order = np.argsort(y, kind='stable')
+        self.leaves = []
+        for t in range(self.n_estimators):
+            leaf_sorted = leaf_ids[order, t]
+            self.leaves.append({})
+            for leaf in np.unique(leaf_sorted):
+                sel = order[leaf_sorted == leaf]
+                w = self._weights(ids[sel])
+                self.leaves[t][leaf] = [y[sel], ids[sel], w, np.cumsum(w)]
+        self.samples = {int(j): (y_j, leaf_id) for j, y_j, leaf_id in zip(ids, y, leaf_ids)}
+        self.num_inserted = 0
+        return self
+
+    def _rescale(self):
+        # Move the reference index to the oldest sample, so the newest weights stay far from overflow
+        self.ref = self.first
+        for leaves in self.leaves:
+            for entry in leaves.values():
+                entry[2] = self._weights(entry[1])
+                entry[3] = np.cumsum(entry[2])
+
+    def _insert(self, j, y, leaf_id):
+        if self.decay is not None and (j - self.ref > 2 * (self.last - self.first + 1) or
+                                       (j - self.ref) * -np.log10(self.decay_weights.c) > 200):
+            # Amortized over the window's worth of insertions since the last rescale
+            self._rescale()
+        self.samples[j] = (y, leaf_id)
+        w = self._weights([j])[0]
+        for leaves, leaf in zip(self.leaves, leaf_id):
+            entry = leaves.get(leaf)
+            if entry is None:
+                leaves[leaf] = [np.array([y]), np.array([j]), np.array([w]), np.array([w])]
+                continue
+            k = np.searchsorted(entry[0], y, side='right')
+            entry[0], entry[1], entry[2] = np.insert(entry[0], k, y), np.insert(entry[1], k, j), np.insert(entry[2], k, w)
+            # Shift the cumulative weights from k on, rather than redoing the cumsum
+            entry[3] = np.insert(entry[3], k, entry[3][k-1] if k > 0 else 0.)
+            entry[3][k:] += w
+
+    def insert(self, j, x, y):
+        x = np.asarray(x, dtype=float)
+        self._insert(j, float(y), self._apply(x)[0])
+        self.last = max(self.last, j)
+        self.num_inserted += 1
+
+    def evict(self, j):
+        y, leaf_id = self.samples.pop(j)
+        for leaves, leaf in zip(self.leaves, leaf_id):
+            entry = leaves[leaf]
+            lo, hi = np.searchsorted(entry[0], y, side='left'), np.searchsorted(entry[0], y, side='right')
+            k = lo + np.flatnonzero(entry[1][lo:hi] == j)[0]
+            entry[3][k+1:] -= entry[2][k]
+            entry[0], entry[1], entry[2], entry[3] = [np.delete(a, k) for a in entry]
+            if not len(entry[0]):
+                del leaves[leaf]
+
+    def update(self, X, y, ids):
+        '''
+            Make the window hold exactly the samples with the contiguous global indices ids: evict the older ones and insert the newer ones
+            Only the ids that left or entered the window are touched, so a step costs O(stride) leaf updates (each a memmove
+            of the leaf's arrays, see the class docstring).
+        '''
+        ids = np.asarray(ids)
+        first, last = int(ids[0]), int(ids[-1])
+        if self.forest is None or (self.rebuild_every is not None and self.num_inserted >= self.rebuild_every) or \
+                first < self.first or first > self.last + 1:
+            return self.fit(X, y, ids)
+        for j in itertools.chain(range(self.first, first), range(last + 1, self.last + 1)):
+            self.evict(j)
+        self.first = first
+        new = ids > self.last
+        if new.any():
+            # Route all new samples through the trees at once
+            leaf_ids = self._apply(np.asarray(X, dtype=float)[new])
+            for j, y_j, leaf_id in zip(ids[new], np.asarray(y, dtype=float)[new], leaf_ids):
+                self._insert(int(j), y_j, leaf_id)
+            self.num_inserted += int(new.sum())
+        self.last = last
+        return self
+
+    def predict(self, X, quantiles=None):
+        '''
+            Weighted empirical quantiles, where a leaf's samples share the weight 1/n_estimators of its tree
+        '''
+        quantiles = np.asarray(self.default_quantiles if quantiles is None else quantiles)
+        X = np.asarray(X, dtype=float).reshape(-1, self.forest.n_features_in_)
+        return np.array([self.leaf_distribution(x).quantile(quantiles) for x in X])
+
+    def leaf_distribution(self, x):
+        entries = [leaves[leaf] for leaves, leaf in zip(self.leaves, self._apply(x)[0]) if leaf in leaves]
+        return LeafMixture([entry[0] for entry in entries], [entry[3] for entry in entries])
+
+
+class ResidualFeaturizer():
+    '''
+        Low-dimensional features of a window of the last w residuals, for SPCI's residual quantile regressor
+        kind:
+            'raw': the w lags themselves (what multi_step_QRF uses without a featurizer)
+            'exp_lags': lags 1, 2, 4, 8, ... up to w
+            'summary': mean, std and mean absolute value of the last 2, 4, 8, ... up to w residuals
+            'projection': num_features Gaussian random projections of the window
+        Windows are keyed by the index of their first residual in the residual stream. Features are cached by that index,
+        so consecutive SPCI steps, whose windows mostly overlap, only featurize the few windows that are new.
+    '''
+
+    def __init__(self, kind='summary', num_features=20, random_state=0):
+        self.kind = kind
+        self.num_features = num_features
+        self.random_state = random_state
+        self.w = None
+
+    def reset(self, w):
+        self.w = w
+        scales = 2 ** np.arange(int(np.log2(w)) + 1)
+        self.lags = scales[scales <= w]
+        self.scales = self.lags[1:]
+        if self.kind == 'projection':
+            rng = np.random.default_rng(self.random_state)
+            self.projection = rng.normal(size=(w, self.num_features)) / np.sqrt(self.num_features)
+        self.clear()
+
+    def _featurize(self, resid, w):
+        '''Features of all length-w windows of resid, vectorized over windows'''
+        windows = sliding_window_view(resid, window_shape=w)
+        if self.kind == 'exp_lags':
+            return windows[:, w - self.lags]
+        if self.kind == 'projection':
+            return windows @ self.projection
+        # Rolling sums from cumulative sums, so every scale costs O(1) per window
+        csum = np.r_[0, np.cumsum(resid)]
+        csum2 = np.r_[0, np.cumsum(resid**2)]
+        cabs = np.r_[0, np.cumsum(np.abs(resid))]
+        end = np.arange(w, len(resid) + 1)
+        features = []
+        for L in self.scales:
+            mean = (csum[end] - csum[end-L]) / L
+            var = (csum2[end] - csum2[end-L]) / L - mean**2
+            features += [mean, np.sqrt(np.maximum(var, 0)), (cabs[end] - cabs[end-L]) / L]
+        return np.column_stack(features)
+
+    def clear(self):
+        '''Forget the cached features, e.g. when the residual stream is recomputed'''
+        self.cache = None
+
+    def transform(self, resid, w, start):
+        '''
+            Features of every length-w window of resid, whose first residual is number start of the stream
+        '''
+        if self.kind == 'raw':
+            return sliding_window_view(resid, window_shape=w)
+        num = len(resid) - w + 1
+        if self.w != w:
+            self.reset(w)
+        if self.cache is None or start < self.start:
+            self.start, self.cache = start, self._featurize(resid, w)
+            self.max_rows = num
+            return self.cache
+        cached_end = self.start + len(self.cache)
+        if start > cached_end:
+            # Not contiguous with the cache (e.g. multi-step features further ahead), so featurize without caching
+            return self._featurize(resid, w)
+        if start + num > cached_end:
+            # Only the windows past the cache need featurizing, from the residuals they span
+            self.cache = np.vstack(
+                [self.cache, self._featurize(resid[cached_end - start:], w)])
+        self.max_rows = max(self.max_rows, num)
+        if len(self.cache) > 2 * self.max_rows:
+            # Later calls only move forward, so the oldest windows are not asked for again
+            self.start += len(self.cache) - self.max_rows
+            self.cache = self.cache[-self.max_rows:]
+        return self.cache[start - self.start:start - self.start + num]
+
+
+class KNNQuantileRegressor():
+    '''
+        Conditional quantiles from the responses of the n_neighbors nearest lag vectors in a sliding window
+        The index is a ring buffer of the window's lag vectors with their squared norms: sample j lives in slot j % capacity,
+        so sliding the window writes the new rows over the evicted ones, and a query is one matrix-vector product.
+        (Space-partitioning trees do not beat this at the hundreds of lag dimensions SPCI uses.)
+        decay: if given, sample j has weight decay**(newest index - j) (as SPCI's weigh_residuals), a float or DecayWeights
+        Same predict(X, quantiles) interface as quantile-forest's RandomForestQuantileRegressor.
+    '''
+
+    def __init__(self, default_quantiles, n_neighbors=50, decay=None):
+        self.default_quantiles = np.asarray(default_quantiles, dtype=float)
+        self.n_neighbors = n_neighbors
+        self.decay = decay
+        self.decay_weights = as_decay_weights(decay)
+        self.capacity = 0
+
+    def fit(self, X, y, ids=None):
+        ids = np.arange(len(y)) if ids is None else np.asarray(ids)
+        X = np.asarray(X, dtype=float).reshape(len(y), -1)
+        self.capacity = 2 * len(y)
+        self.X = np.zeros((self.capacity, X.shape[1]))
+        self.y = np.zeros(self.capacity)
+        self.norms = np.zeros(self.capacity)
+        self.ids = np.full(self.capacity, -1)
+        self.first, self.last = ids[0], ids[0] - 1
+        return self.update(X, y, ids)
+
+    def update(self, X, y, ids):
+        '''
+            Make the window hold exactly the samples with the contiguous global indices ids
+        '''
+        ids = np.asarray(ids)
+        if len(ids) > self.capacity or ids[0] < self.first or ids[0] > self.last + 1:
+            return self.fit(X, y, ids)
+        new = ids > self.last
+        X_new = np.asarray(X, dtype=float)[new].reshape(new.sum(), -1)
+        slots = ids[new] % self.capacity
+        self.X[slots] = X_new
+        self.y[slots] = np.asarray(y, dtype=float)[new]
+        self.norms[slots] = (X_new**2).sum(1)
+        self.ids[slots] = ids[new]
+        self.first, self.last = ids[0], ids[-1]
+        return self
+
+    def leaf_distribution(self, x):
+        '''Distribution of the responses of the nearest neighbours of x'''
+        x = np.asarray(x, dtype=float).ravel()
+        dist = self.norms - 2 * self.X @ x
+        valid = (self.ids >= self.first) & (self.ids <= self.last)
+        dist[~valid] = np.inf
+        k = min(self.n_neighbors, valid.sum())
+        nn = np.argpartition(dist, k - 1)[:k]
+        # One interpolation rule whether or not the neighbours are weighted
+        weights = np.ones(k) if self.decay is None else self.decay_weights.ages(self.last - self.ids[nn])
+        return LeafDistribution(self.y[nn], weights, 'inverted_cdf')
+
+    def predict(self, X, quantiles=None):
+        quantiles = self.default_quantiles if quantiles is None else quantiles
+        X = np.asarray(X, dtype=float).reshape(-1, self.X.shape[1])
+        return np.array([self.leaf_distribution(x).quantile(quantiles) for x in X])
+
+
+class LinearQuantileRegressor():
+    '''
+        Linear quantile regression at all levels default_quantiles jointly, by ADMM on min sum_i w_i rho_q(y_i - x_i beta_q)
+        All levels share the (ridge-regularized) Gram matrix, whose inverse is kept up to date by Sherman-Morrison
+        updates as samples enter/leave the sliding window, and each update warm-starts from the previous solution,
+        so that a step costs a few matrix-vector products instead of a linear program per level.
+        decay: if given, sample j has weight decay**(newest index - j) (as SPCI's weigh_residuals), a float or DecayWeights
+        Same predict(X, quantiles) interface as quantile-forest's RandomForestQuantileRegressor.
+    '''
+
+    def __init__(self, default_quantiles, rho=1.0, ridge=1e-4, max_iter=5, max_iter_fit=500, tol=1e-6,
+                 decay=None, refresh_every=100):
+        self.default_quantiles = np.asarray(default_quantiles, dtype=float)
+        self.rho = rho
+        self.ridge = ridge
+        self.max_iter = max_iter
+        self.max_iter_fit = max_iter_fit
+        self.tol = tol
+        self.decay = decay
+        self.decay_weights = as_decay_weights(decay)
+        self.refresh_every = refresh_every
+        self.coef_ = None
+
+    def _design(self, X):
+        X = np.asarray(X, dtype=float)
+        return np.c_[np.ones(len(X)), X.reshape(len(X), -1)]
+
+    def fit(self, X, y, ids=None):
+        self.ids = np.arange(len(y)) if ids is None else np.asarray(ids)
+        self.X, self.y = self._design(X), np.asarray(y, dtype=float)
+        self._refresh()
+        num_levels = len(self.default_quantiles)
+        # Least squares start for all levels
+        self.coef_ = np.repeat(self.G @ (self.X.T @ self.y)[:, None], num_levels, axis=1)
+        self.r = self.y[:, None] - self.X @ self.coef_
+        self.u = np.zeros_like(self.r)
+        self._admm(self.max_iter_fit)
+        return self
+
+    def _refresh(self):
+        d = self.X.shape[1]
+        self.G = np.linalg.inv(self.X.T @ self.X + self.ridge * np.eye(d))
+        self.num_updates = 0
+
+    def _rank_one(self, x, sign):
+        # (A + sign x x^T)^{-1} from A^{-1}
+        Gx = self.G @ x
+        self.G -= sign * np.outer(Gx, Gx) / (1 + sign * x @ Gx)
+        self.num_updates += 1
+
+    def update(self, X, y, ids):
+        '''
+            Make the window hold exactly the samples with the contiguous global indices ids, and re-solve from the last solution
+        '''
+        ids = np.asarray(ids)
+        if self.coef_ is None or ids[0] > self.ids[-1] + 1 or ids[0] < self.ids[0]:
+            return self.fit(X, y, ids)
+        keep = (self.ids >= ids[0]) & (self.ids <= ids[-1])
+        new = ids > self.ids[-1]
+        X_new, y_new = self._design(np.asarray(X)[new]), np.asarray(y, dtype=float)[new]
+        for x in self.X[~keep]:
+            self._rank_one(x, -1)
+        for x in X_new:
+            self._rank_one(x, 1)
+        self.X = np.r_[self.X[keep], X_new]
+        self.y = np.r_[self.y[keep], y_new]
+        self.ids = np.r_[self.ids[keep], ids[new]]
+        # New samples start at their residual under the current solution
+        self.r = np.r_[self.r[keep], y_new[:, None] - X_new @ self.coef_]
+        self.u = np.r_[self.u[keep], np.zeros((len(y_new), self.u.shape[1]))]
+        if self.num_updates >= self.refresh_every:
+            # Recompute the inverse now and then, so that rounding errors of the rank-one updates do not build up
+            self._refresh()
+        self._admm(self.max_iter)
+        return self
+
+    def _admm(self, max_iter):
+        # Split r = y - X beta: beta-step is a shared least squares, r-step is the proximal map of the check loss
+        weights = np.ones(len(self.y)) if self.decay is None else \
+            self.decay_weights.ages(self.ids[-1] - self.ids)
+        upper = weights[:, None] * self.default_quantiles / self.rho
+        lower = upper - weights[:, None] / self.rho
+        for _ in range(max_iter):
+            self.coef_ = self.G @ (self.X.T @ (self.y[:, None] - self.r - self.u))
+            fitted = self.X @ self.coef_
+            v = self.y[:, None] - fitted - self.u
+            self.r = v - np.clip(v, lower, upper)
+            primal = fitted + self.r - self.y[:, None]
+            self.u += primal
+            if np.abs(primal).max() < self.tol:
+                break
+
+    def predict(self, X, quantiles=None):
+        cols = slice(None) if quantiles is None else \
+            [int(np.argmin(np.abs(self.default_quantiles - q))) for q in quantiles]
+        preds = self._design(X) @ self.coef_
+        # Rearrange so that predicted quantiles do not cross, which would make some widths negative
+        order = np.argsort(self.default_quantiles, kind='stable')
+        preds[:, order] = np.sort(preds[:, order], axis=1)
+        return preds[:, cols]
+
+
+class QRF_refit_policy():
+    '''
+        Decides at which test indices SPCI refits its multi-step QRFs; in between, the last QRFs predict on fresh features.
+        Any of the triggers below may be combined, a refit happens when one of them fires:
+        every: refit when this many steps passed since the last refit (1 = refit every step, the default SPCI behaviour)
+        coverage_drift: refit when the empirical coverage over the (at most drift_window) steps since the last refit
+            deviates from 1-alpha by more than this (for any alpha, when SPCI computes several levels at once)
+        resid_drift: refit when the two-sample Kolmogorov-Smirnov statistic between the residuals since the last refit
+            and the last drift_window residuals the QRFs were trained on exceeds this
+        min_drift_steps: drift triggers need at least this many new residuals
+        time_budget: total secs allowed for refits; a refit is skipped once the next one (at the mean refit cost) would exceed it
+    '''
+
+    def __init__(self, every=1, coverage_drift=None, resid_drift=None, drift_window=100, min_drift_steps=20,
+                 time_budget=None):
+        self.every = every
+        self.coverage_drift = coverage_drift
+        self.resid_drift = resid_drift
+        self.drift_window = drift_window
+        self.min_drift_steps = min_drift_steps
+        self.time_budget = time_budget
+        self.reset(alpha=0.1)
+
+    def reset(self, alpha):
+        self.alpha = alpha
+        self.refit_idx = []  # test indices at which the QRFs were refit
+        self.refit_secs = []
+        self.wid_ls = []  # (unscaled) width of each step since the last refit
+        self.trained_resid = np.array([])
+
+    def should_refit(self, i, past_resid):
+        '''
+            i: current test index; past_resid: residuals observed up to (excluding) i
+        '''
+        if not self.refit_idx:
+            return True
+        if self.time_budget is not None and sum(self.refit_secs) + np.mean(self.refit_secs) > self.time_budget:
+            return False
+        since = i - self.refit_idx[-1]
+        if self.every is not None and since >= self.every:
+            return True
+        # Counted from the test indices, as widths may only be recorded once the QRFs are done (batched prediction)
+        num_new = min(since, self.drift_window)
+        if num_new < self.min_drift_steps:
+            return False
+        new_resid = past_resid[len(past_resid)-num_new:]
+        if self.coverage_drift is not None and len(self.wid_ls) >= self.min_drift_steps:
+            wid = np.array(self.wid_ls[-num_new:])  # num_new-by-2, or num_new-by-2-by-len(alpha)
+            covered = np.reshape(new_resid[len(new_resid)-len(wid):], (-1,) + (1,) * (wid.ndim - 2))
+            coverage = ((covered >= wid[:, 0]) & (covered <= wid[:, 1])).mean(0)
+            if np.any(np.abs(coverage - (1 - np.asarray(self.alpha))) > self.coverage_drift):
+                return True
+        if self.resid_drift is not None:
+            if stats.ks_2samp(new_resid, self.trained_resid).statistic > self.resid_drift:
+                return True
+        return False
+
+    def refitted(self, i, past_resid, secs):
+        self.refit_idx.append(i)
+        self.refit_secs.append(secs)
+        self.wid_ls = []
+        self.trained_resid = np.array(past_resid[-self.drift_window:])
+
+    def record(self, wid_left, wid_right):
+        self.wid_ls.append((wid_left, wid_right))
+
+
+def binning_use_RF_quantile_regr(quantile_regr, Xtrain, Ytrain, feature, beta_ls, sample_weight=None, quantiles=None,
+                                 quantile_idx=None, return_dist=False):
+    '''
+        quantile_idx: for several alpha sharing one fit, the len(alpha)-by-2*bins positions of each alpha's levels in
+            quantiles (SPCI_and_EnbPI.QRF_quantiles). Then i_star, wid_left and wid_right have one entry per alpha,
+            and beta_ls (if given) is indexed by i_star.
+        return_dist: also return the LeafDistribution at feature (None if the regressor has no leaf samples), which
+            gives the widths at feature for any beta without going through the forest again
+    '''
     # API ref: https://zillow.github.io/quantile-forest/
     feature = feature.reshape(1, -1)
+    leaf_dist = None
 
     # quantile-forest requires explicit quantiles in predict()
     # Use the quantiles stored in the regressor's default_quantiles if not provided
@@ -107,8 +946,12 @@ def binning_use_RF_quantile_regr(quantile_regr, Xtrain, Ytrain, feature, beta_ls
     # Fit the quantile regressor
     quantile_regr.fit(Xtrain, Ytrain, sample_weight=sample_weight)
 
+    if quantiles is not None and hasattr(quantile_regr, 'proximity_counts'):
+        # Read all quantiles off the query's weighted leaf samples, instead of one forest pass per quantile
+        leaf_dist = leaf_distribution(quantile_regr, Ytrain, feature)
+        low_high_pred = leaf_dist.quantile(quantiles)
     # quantile-forest uses quantiles= parameter instead of q=
-    if quantiles is not None and hasattr(quantile_regr, 'default_quantiles'):
+    elif quantiles is not None and hasattr(quantile_regr, 'default_quantiles'):
         # This is a quantile-forest regressor
         # Convert numpy array to list for quantile-forest compatibility
         quantiles_list = quantiles.tolist() if hasattr(quantiles, 'tolist') else quantiles
@@ -119,12 +962,24 @@ def binning_use_RF_quantile_regr(quantile_regr, Xtrain, Ytrain, feature, beta_ls
         # Fallback for non-quantile regressors (standard RandomForestRegressor)
         low_high_pred = quantile_regr.predict(feature)
 
-    num_mid = int(len(low_high_pred)/2)
-    low_pred, high_pred = low_high_pred[:num_mid], low_high_pred[num_mid:]
-    width = (high_pred-low_pred).flatten()
-    i_star = np.argmin(width)
-    wid_left, wid_right = low_pred[i_star], high_pred[i_star]
-    return i_star, beta_ls[i_star], wid_left, wid_right
+    if quantile_idx is not None:
+        # One row of lower ends followed by upper ends per alpha
+        low_high_pred = np.asarray(low_high_pred).ravel()[quantile_idx]
+        num_mid = low_high_pred.shape[1] // 2
+        low_pred, high_pred = low_high_pred[:, :num_mid], low_high_pred[:, num_mid:]
+        i_star = np.argmin(high_pred - low_pred, axis=1)
+        rows = np.arange(len(i_star))
+        wid_left, wid_right = low_pred[rows, i_star], high_pred[rows, i_star]
+    else:
+        num_mid = int(len(low_high_pred)/2)
+        low_pred, high_pred = low_high_pred[:num_mid], low_high_pred[num_mid:]
+        width = (high_pred-low_pred).flatten()
+        i_star = np.argmin(width)
+        wid_left, wid_right = low_pred[i_star], high_pred[i_star]
+    beta_star = None if beta_ls is None else np.asarray(beta_ls)[i_star]
+    if return_dist:
+        return i_star, beta_star, wid_left, wid_right, leaf_dist
+    return i_star, beta_star, wid_left, wid_right
 
 
 def merge_table_mean_std(table_result, colnames=None):
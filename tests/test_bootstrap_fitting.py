@@ -0,0 +1,210 @@
+import pytest
+import numpy as np
+import torch
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import LinearRegression, Ridge
+from spci.data import real_data_loader
+import spci.SPCI_class as SPCI
+
+
+class TestBootstrapFitting:
+    """Tests for the bootstrap fitting stage of SPCI_and_EnbPI"""
+
+    @pytest.fixture
+    def setup_data(self):
+        """Small slice of the electric dataset to keep the fits fast"""
+        dloader = real_data_loader()
+        X_full, Y_full = dloader.electric_dataset()
+        X_full = torch.from_numpy(X_full[:600])
+        Y_full = torch.from_numpy(Y_full[:600])
+        N = 450
+        return X_full[:N], X_full[N:], Y_full[:N], Y_full[N:]
+
+    def fit(self, setup_data, seed=1103, **kwargs):
+        X_train, X_predict, Y_train, Y_predict = setup_data
+        fit_func = RandomForestRegressor(
+            n_estimators=10, max_depth=1, criterion='squared_error',
+            bootstrap=False, n_jobs=1, random_state=1103
+        )
+        enbpi = SPCI.SPCI_and_EnbPI(X_train, X_predict, Y_train, Y_predict, fit_func=fit_func)
+        np.random.seed(seed)
+        enbpi.fit_bootstrap_models_online_multistep(B=6, fit_sigmaX=False, **kwargs)
+        return enbpi
+
+    @pytest.mark.parametrize("stride", [1, 2])
+    def test_parallel_matches_serial(self, setup_data, stride):
+        """Process-pool fitting gives bit-identical LOO quantities"""
+        serial = self.fit(setup_data, stride=stride)
+        parallel = self.fit(setup_data, stride=stride, n_jobs=2)
+        np.testing.assert_array_equal(serial.Ensemble_online_resid,
+                                      parallel.Ensemble_online_resid)
+        np.testing.assert_array_equal(serial.Ensemble_pred_interval_centers,
+                                      parallel.Ensemble_pred_interval_centers)
+
+    def test_LOO_weights_match_loop(self):
+        """Masked LOO weights reproduce the per-index out-of-bag means"""
+        rng = np.random.default_rng(0)
+        B, N, n = 5, 40, 45
+        in_boot_sample = rng.random((B, N)) < 0.6
+        in_boot_sample[:, 3] = True  # every model trained on index 3
+        preds = rng.normal(size=(B, n))
+        W = SPCI.utils.LOO_weights(in_boot_sample, np.arange(n))
+        for i in range(n):
+            if i >= N:
+                expected = preds[:, i].mean()
+            elif in_boot_sample[:, i].all():
+                expected = preds[0, i]
+            else:
+                expected = preds[~in_boot_sample[:, i], i].mean()
+            assert np.isclose((W[:, i] * preds[:, i]).sum(), expected)
+
+    def test_batched_MLP_predictions(self):
+        """Batched MLP ensemble returns one (B, n+n1) prediction matrix"""
+        torch.manual_seed(0)
+        X = torch.randn(60, 3)
+        Y = X.sum(1) + 0.1 * torch.randn(60)
+        enbpi = SPCI.SPCI_and_EnbPI(X[:50], X[50:], Y[:50], Y[50:])
+        enbpi.d, enbpi.fit_sigmaX = 3, True
+        boot_idx = np.random.default_rng(0).integers(0, 50, (4, 50))
+        fX, sigmaX = enbpi.batched_boot_prediction(X[boot_idx], Y[boot_idx], X)
+        assert fX.shape == (4, 60) and sigmaX.shape == (4, 60)
+        assert np.all(np.isfinite(fX)) and np.all(sigmaX > 0)
+
+    def test_forest_OOB_mode(self, setup_data):
+        """One bagged forest stands in for B bootstrap fits"""
+        X_train, X_predict, Y_train, Y_predict = setup_data
+        fit_func = RandomForestRegressor(max_depth=2, random_state=1103)
+        enbpi = SPCI.SPCI_and_EnbPI(X_train, X_predict, Y_train, Y_predict, fit_func=fit_func)
+        enbpi.use_forest_OOB = True
+        enbpi.fit_bootstrap_models_online_multistep(B=20, fit_sigmaX=False)
+        assert np.all(np.isfinite(enbpi.Ensemble_online_resid))
+
+        forest = RandomForestRegressor(n_estimators=20, max_depth=2, random_state=0)
+        X, Y = X_train.numpy(), Y_train.numpy()
+        in_boot_sample, boot_predictions = SPCI.utils.forest_OOB_predictions(forest, X, Y, X)
+        assert in_boot_sample.shape == (20, len(X))
+        assert np.all(in_boot_sample.mean(1) < 0.8)
+        np.testing.assert_allclose(boot_predictions.mean(0), forest.predict(X))
+
+    @pytest.mark.parametrize("regressor", [LinearRegression(), Ridge(alpha=3.0)])
+    def test_batched_linear_matches_sklearn(self, regressor):
+        """Closed-form batched bootstrap equals B weighted sklearn fits"""
+        rng = np.random.default_rng(0)
+        n, B = 80, 4
+        X, Y = rng.normal(size=(n, 3)), rng.normal(size=n)
+        samples_idx = rng.integers(0, n, (B, n))
+        tags = 0.99**np.arange(n, 0, -1)
+        weights = SPCI.utils.bootstrap_counts(samples_idx, n, tags)
+        preds = SPCI.utils.batched_linear_boot_predictions(
+            X, Y, X, weights, alpha=getattr(regressor, 'alpha', 0))
+        for b in range(B):
+            regressor.fit(X[samples_idx[b]], Y[samples_idx[b]], sample_weight=tags)
+            np.testing.assert_allclose(preds[b], regressor.predict(X), atol=1e-8)
+
+    @pytest.mark.parametrize("regressor", [LinearRegression(), LinearRegression(positive=True)])
+    def test_batch_linear_is_opt_in(self, setup_data, regressor):
+        """The closed-form path matches the sklearn fits, and is not used where it would ignore settings"""
+        X_train, X_predict, Y_train, Y_predict = setup_data
+        centers = []
+        for batch_linear in [False, True]:
+            enbpi = SPCI.SPCI_and_EnbPI(X_train, X_predict, Y_train, Y_predict, fit_func=regressor)
+            enbpi.batch_linear = batch_linear
+            enbpi.fit_bootstrap_models_online_multistep(B=4, fit_sigmaX=False, seed=0)
+            centers.append(enbpi.Ensemble_pred_interval_centers)
+        np.testing.assert_allclose(centers[0], centers[1], rtol=1e-6)
+
+    @pytest.mark.parametrize("mode", ['RF', 'stride', 'forest_OOB', 'batch_linear', 'MLP', 'batch_MLP', 'anytime', 'append'])
+    def test_kept_models_reproduce_test_centers(self, mode):
+        """The kept bootstrap models give the test centers again when evaluated at X_predict"""
+        torch.manual_seed(0)
+        X = torch.randn(80, 3)
+        Y = X.sum(1) + 0.1 * torch.randn(80)
+        fit_func = RandomForestRegressor(n_estimators=5, max_depth=2, random_state=0)
+        if mode == 'batch_linear':
+            fit_func = Ridge(alpha=1.0)
+        elif mode in ('MLP', 'batch_MLP'):
+            fit_func = None
+        enbpi = SPCI.SPCI_and_EnbPI(X[:50], X[60:], Y[:50], Y[60:], fit_func=fit_func)
+        enbpi.use_forest_OOB = mode == 'forest_OOB'
+        enbpi.batch_linear = mode == 'batch_linear'
+        enbpi.batch_MLP = mode == 'batch_MLP'
+        stride = 2 if mode == 'stride' else 1
+        if mode == 'anytime':
+            enbpi.fit_bootstrap_models_anytime(B_max=6, B_batch=3, tol=0, fit_sigmaX=False, seed=0)
+        else:
+            enbpi.fit_bootstrap_models_online_multistep(B=3, fit_sigmaX=mode == 'MLP', stride=stride, seed=0)
+        if mode == 'append':
+            enbpi.append_training(X[50:60], Y[50:60], refit_frac=0.5, seed=1)
+        for s in range(stride):
+            center, sigma = enbpi.predict_center(X[60::stride], s)
+            np.testing.assert_allclose(center, enbpi.Ensemble_pred_interval_centers[s::stride], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(sigma, enbpi.Ensemble_pred_interval_sigma[s::stride], rtol=1e-5)
+        enbpi.keep_boot_models = False
+        enbpi.fit_bootstrap_models_online_multistep(B=3, fit_sigmaX=False, stride=stride, seed=0)
+        with pytest.raises(ValueError):
+            enbpi.predict_center(X[60:])
+
+    def test_seeded_bootstrap_samples(self):
+        """Seeded samples are reproducible and row b does not depend on B"""
+        idx5, counts5 = SPCI.utils.generate_bootstrap_samples(50, 50, 5, seed=7, return_counts=True)
+        idx3 = SPCI.utils.generate_bootstrap_samples(50, 50, 3, seed=7)
+        np.testing.assert_array_equal(idx5[:3], idx3)
+        np.testing.assert_array_equal(counts5.sum(1), np.full(5, 50))
+        np.testing.assert_array_equal(counts5[2], np.bincount(idx5[2], minlength=50))
+        subsample = SPCI.utils.generate_bootstrap_samples(50, 20, 4, seed=7, replace=False)
+        assert all(len(np.unique(row)) == 20 for row in subsample)
+
+    def test_seed_parallel_matches_serial(self, setup_data):
+        """With a seed, results do not depend on the global RNG or on n_jobs"""
+        X_train, X_predict, Y_train, Y_predict = setup_data
+        resids = []
+        for global_seed, n_jobs in [(1, 1), (2, 2)]:
+            enbpi = SPCI.SPCI_and_EnbPI(X_train, X_predict, Y_train, Y_predict,
+                                        fit_func=RandomForestRegressor(n_estimators=5, max_depth=1, random_state=0))
+            np.random.seed(global_seed)
+            enbpi.fit_bootstrap_models_online_multistep(
+                B=4, fit_sigmaX=False, stride=2, n_jobs=n_jobs, seed=11)
+            resids.append(enbpi.Ensemble_online_resid)
+        np.testing.assert_array_equal(resids[0], resids[1])
+
+    def test_append_training(self, setup_data):
+        """Appending data refits a rotating subset and keeps LOO quantities finite"""
+        X_train, X_predict, Y_train, Y_predict = setup_data
+        enbpi = self.fit((X_train[:400], X_predict, Y_train[:400], Y_predict))
+        enbpi.append_training(X_train[400:], Y_train[400:], refit_frac=0.5, seed=3)
+        assert enbpi.refit_pointer == 3
+        assert len(enbpi.Ensemble_online_resid) == len(X_train) + len(X_predict)
+        assert np.all(np.isfinite(enbpi.Ensemble_online_resid))
+        assert enbpi.boot_available[:3, 400:].all() and not enbpi.boot_available[3:, 400:].any()
+        # New points are only predicted by the refit models that left them out-of-bag
+        W = SPCI.utils.LOO_weights(enbpi.in_boot_sample, enbpi.train_idx, enbpi.boot_available)
+        assert np.all(W[3:, 400:] == 0)
+        np.testing.assert_allclose(W.sum(0), 1)
+        with pytest.raises(ValueError):
+            self.fit(setup_data, stride=2).append_training(X_train[:5], Y_train[:5])
+
+    def test_append_training_seeded_MLP(self):
+        """Seeded appends refit the MLPs identically, whatever the global torch state"""
+        torch.manual_seed(0)
+        X = torch.randn(70, 3)
+        Y = X.sum(1) + 0.1 * torch.randn(70)
+        resids = []
+        for global_seed in [1, 2]:
+            enbpi = SPCI.SPCI_and_EnbPI(X[:50], X[60:], Y[:50], Y[60:])
+            enbpi.fit_bootstrap_models_online_multistep(B=2, fit_sigmaX=False, seed=0)
+            torch.manual_seed(global_seed)
+            enbpi.append_training(X[50:60], Y[50:60], refit_frac=0.5, seed=3)
+            resids.append(enbpi.Ensemble_online_resid)
+        np.testing.assert_array_equal(resids[0], resids[1])
+
+    def test_anytime_fitting(self, setup_data):
+        """Anytime fitting stops early on a loose tolerance and matches a one-shot fit at B_max"""
+        X_train, X_predict, Y_train, Y_predict = setup_data
+        fit_func = RandomForestRegressor(n_estimators=5, max_depth=1, random_state=0)
+        loose = SPCI.SPCI_and_EnbPI(X_train, X_predict, Y_train, Y_predict, fit_func=fit_func)
+        loose.fit_bootstrap_models_anytime(B_max=12, B_batch=3, tol=10, fit_sigmaX=False, seed=5)
+        assert loose.B_used == 6
+        full = SPCI.SPCI_and_EnbPI(X_train, X_predict, Y_train, Y_predict, fit_func=fit_func)
+        full.fit_bootstrap_models_anytime(B_max=6, B_batch=3, tol=0, fit_sigmaX=False, seed=5)
+        assert full.B_used == 6 and full.in_boot_sample.shape[0] == 6
+        np.testing.assert_array_equal(loose.Ensemble_online_resid, full.Ensemble_online_resid)
@@ -0,0 +1,46 @@
+import pytest
+import numpy as np
+from sklearn.linear_model import Ridge, RidgeCV
+from spci.PI_class_EnbPI import prediction_interval
+from spci import utils_EnbPI
+
+
+class TestPredictionIntervalClass:
+    """Tests for the LOO stage of PI_class_EnbPI.prediction_interval"""
+
+    @pytest.fixture
+    def setup_data(self):
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(120, 3))
+        Y = X.sum(1) + rng.normal(size=120)
+        return X[:90], X[90:], Y[:90], Y[90:]
+
+    def test_ridge_jackknife_is_exact(self, setup_data):
+        """Hat-matrix LOO quantities equal n explicit leave-one-out ridge fits"""
+        X_train, X_predict, Y_train, _ = setup_data
+        resid_LOO, pred_LOO_mean = utils_EnbPI.ridge_jackknife(
+            X_train, Y_train, X_predict, alpha=2.0)
+        resid_expected, pred_expected = [], []
+        for i in range(len(X_train)):
+            model = Ridge(alpha=2.0).fit(np.delete(X_train, i, 0), np.delete(Y_train, i))
+            resid_expected.append(Y_train[i] - model.predict(X_train[i:i+1])[0])
+            pred_expected.append(model.predict(X_predict))
+        np.testing.assert_allclose(resid_LOO, resid_expected, atol=1e-10)
+        np.testing.assert_allclose(pred_LOO_mean, np.mean(pred_expected, 0), atol=1e-10)
+
+    def test_ridge_jackknife_online_feeds_PIs(self, setup_data):
+        """The analytic mode produces residuals and centers usable by compute_PIs_Ensemble_online"""
+        ridge = RidgeCV(alphas=np.linspace(1e-4, 10, 10))
+        PI_class = prediction_interval(ridge, *setup_data)
+        PI_class.fit_ridge_jackknife_online(miss_test_idx=[])
+        assert len(PI_class.Ensemble_online_resid) == 120
+        PIs = PI_class.compute_PIs_Ensemble_online(0.1, stride=1)
+        assert np.all(PIs['lower'] <= PIs['upper'])
+
+    def test_missing_test_resid_forward_fill(self, setup_data):
+        """Missing test residuals take the latest observed one (training residual at the start)"""
+        PI_class = prediction_interval(Ridge(), *setup_data)
+        PI_class.Ensemble_online_resid = np.array([-1.0])
+        resid = PI_class.fill_missing_test_resid(
+            np.arange(8.0), miss_test_idx=[0, 1, 4, 5, 7])
+        np.testing.assert_array_equal(resid, [-1, -1, 2, 3, 3, 3, 6, 6])
@@ -1,4 +1,5 @@
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 from sklearn.ensemble import RandomForestRegressor
@@ -31,6 +32,17 @@ class TestPredictionIntervals:
                                          use_SPCI=False, quantile_regr=False, stride=1)
         return enbpi
 
+    @pytest.fixture
+    def setup_small_enbpi(self):
+        """EnbPI fitted on 300 electric points with 30 test points, for the SPCI backtests"""
+        dloader = real_data_loader()
+        X_full, Y_full = dloader.electric_dataset()
+        X_full, Y_full = torch.from_numpy(X_full[:330]), torch.from_numpy(Y_full[:330])
+        fit_func = RandomForestRegressor(n_estimators=10, max_depth=1, random_state=1103)
+        enbpi = SPCI.SPCI_and_EnbPI(X_full[:300], X_full[300:], Y_full[:300], Y_full[300:], fit_func=fit_func)
+        enbpi.fit_bootstrap_models_online_multistep(B=5, fit_sigmaX=False, seed=0)
+        return enbpi
+
     def test_pi_bounds_are_valid(self, setup_enbpi):
         """Test that lower bounds <= upper bounds"""
         enbpi = setup_enbpi
@@ -60,3 +72,364 @@ class TestPredictionIntervals:
 
         # For 90% target, actual should be at least 85% (conservative)
         assert coverage >= 0.85, f"Coverage {coverage} is below minimum threshold 0.85"
+
+    def test_binning_strided_matches_binning(self):
+        """Batched binning equals per-window binning, also across chunks"""
+        rng = np.random.default_rng(0)
+        resid_strided = SPCI.utils.strided_app(rng.standard_t(3, size=400), 100, 1)
+        beta_hat_bins, width_left, width_right = SPCI.utils.binning_strided(
+            resid_strided, 0.1, max_elements=1000)
+        for i, past_resid in enumerate(resid_strided):
+            beta = SPCI.utils.binning(past_resid, 0.1)
+            assert beta_hat_bins[i] == beta
+            assert width_left[i] == np.percentile(past_resid, np.ceil(100 * beta))
+            assert width_right[i] == np.percentile(past_resid, np.ceil(100 * (0.9 + beta)))
+
+    def test_sorted_window_matches_numpy(self):
+        """SortedWindow percentiles equal np.percentile while sliding, and so does binning_sliding"""
+        rng = np.random.default_rng(1)
+        resid = rng.standard_t(3, size=1500)
+        window = SPCI.utils.SortedWindow(resid[:300], load=8)
+        for t in range(300, len(resid)):
+            window.evict(resid[t-300])
+            window.insert(resid[t])
+            if t % 50 == 0:
+                for q in [0, 3, 50, 96, 100]:
+                    assert window.percentile(q) == np.percentile(resid[t-299:t+1], q)
+        with pytest.raises(ValueError):
+            window.evict(1e9)
+        for stride in [1, 4]:
+            sliding = SPCI.utils.binning_sliding(resid, 300, 0.1, stride)
+            strided = SPCI.utils.binning_strided(SPCI.utils.strided_app(resid, 300, stride), 0.1)
+            for a, b in zip(sliding, strided):
+                np.testing.assert_array_equal(a, b)
+
+    @pytest.mark.parametrize("use_SPCI,every,featurizer,T1", [(False, 1, None, None), (True, 1, None, None),
+                                                              (True, 4, None, None), (True, 1, 'summary', None),
+                                                              (True, 1, None, 80)])
+    def test_online_predictor_matches_offline(self, setup_small_enbpi, use_SPCI, every, featurizer, T1):
+        """Streaming intervals equal the offline backtest on the same residuals"""
+        enbpi = setup_small_enbpi
+        if featurizer is not None:
+            enbpi.resid_featurizer = SPCI.utils.ResidualFeaturizer(kind=featurizer)
+        if T1 is not None:
+            # Bounded, weighted history
+            enbpi.T1, enbpi.weigh_residuals = T1, True
+        np.random.seed(0)
+        enbpi.compute_PIs_Ensemble_online(0.1, smallT=not use_SPCI, past_window=100, use_SPCI=use_SPCI,
+                                          refit_policy=SPCI.utils.QRF_refit_policy(every=every))
+        offline = enbpi.PIs_Ensemble.to_numpy()
+        if use_SPCI:
+            assert enbpi.refit_policy.refit_idx == list(range(0, 30, every))
+
+        np.random.seed(0)
+        predictor = SPCI.SPCI_online_predictor(enbpi, 0.1, past_window=100, use_SPCI=use_SPCI,
+                                               refit_policy=SPCI.utils.QRF_refit_policy(every=every))
+        online = []
+        for x_t, y_t in zip(enbpi.X_predict, enbpi.Y_predict):
+            online.append(predictor.predict_interval(x_t))
+            predictor.update(y_t)
+        np.testing.assert_allclose(np.array(online), offline)
+        if T1 is not None:
+            assert enbpi.T1 == T1 and predictor.window == T1 + 100
+
+    def test_online_predictor_streams_past_X_predict(self, setup_small_enbpi):
+        """Centers come from the bootstrap models at x_t, so the stream can outlast X_predict"""
+        enbpi = setup_small_enbpi
+        X_full, Y_full = real_data_loader().electric_dataset()
+        X_full, Y_full = torch.from_numpy(X_full[:360]), torch.from_numpy(Y_full[:360])
+        predictor = SPCI.SPCI_online_predictor(enbpi, 0.1, past_window=50)
+        PIs = []
+        for x_t, y_t in zip(X_full[300:], Y_full[300:]):
+            PIs.append(predictor.predict_interval(x_t))
+            predictor.update(y_t)
+        PIs = np.array(PIs)
+        assert predictor.t == 60 and np.all(np.isfinite(PIs)) and np.all(PIs[:, 0] <= PIs[:, 1])
+        center = np.mean(predictor.predict_interval(X_full[300]))
+        assert np.mean(SPCI.SPCI_online_predictor(enbpi, 0.1, past_window=50).predict_interval(-X_full[300])) != center
+        # Without x_t only the cached centers of X_predict are available
+        predictor = SPCI.SPCI_online_predictor(enbpi, 0.1, past_window=50)
+        for y_t in Y_full[300:330]:
+            predictor.predict_interval()
+            predictor.update(y_t)
+        with pytest.raises(ValueError):
+            predictor.predict_interval()
+
+    @pytest.mark.parametrize("use_SPCI", [False, True])
+    def test_online_predictor_multiple_alphas(self, setup_small_enbpi, use_SPCI):
+        """Streaming intervals for a list of alpha equal the offline backtest, one column pair per alpha"""
+        enbpi = setup_small_enbpi
+        alphas = [0.05, 0.1, 0.2]
+        np.random.seed(0)
+        offline = enbpi.compute_PIs_Ensemble_online(alphas, smallT=not use_SPCI, past_window=100,
+                                                    use_SPCI=use_SPCI).to_numpy().reshape(30, len(alphas), 2)
+        np.random.seed(0)
+        predictor = SPCI.SPCI_online_predictor(enbpi, alphas, past_window=100, use_SPCI=use_SPCI)
+        online = []
+        for x_t, y_t in zip(enbpi.X_predict, enbpi.Y_predict):
+            online.append(np.stack(predictor.predict_interval(x_t), axis=-1))
+            predictor.update(y_t)
+        np.testing.assert_allclose(np.array(online), offline)
+
+    def test_refit_policy_triggers(self):
+        """Drift and time-budget triggers of the QRF refit policy"""
+        rng = np.random.default_rng(0)
+        past_resid = rng.normal(size=200)
+        policy = SPCI.utils.QRF_refit_policy(every=None, coverage_drift=0.2, resid_drift=0.5, min_drift_steps=10)
+        policy.reset(0.1)
+        assert policy.should_refit(0, past_resid[:100])
+        policy.refitted(0, past_resid[:100], 1.0)
+        for _ in range(30):
+            policy.record(-1.6, 1.6)
+        assert not policy.should_refit(30, past_resid[:130])
+        shifted = np.r_[past_resid[:100], past_resid[100:130] + 3]
+        assert policy.should_refit(30, shifted)
+        policy.coverage_drift = None  # the KS trigger alone also fires on the shift
+        assert policy.should_refit(30, shifted)
+        policy.time_budget = 1.5
+        assert not policy.should_refit(30, shifted)
+
+    def test_resid_drift_refits_SPCI_backtest(self, setup_small_enbpi):
+        """A level shift in the test residuals triggers KS refits while widths are batched between refits"""
+        enbpi = setup_small_enbpi
+        enbpi.Ensemble_online_resid[300:] += 8
+        policy = SPCI.utils.QRF_refit_policy(every=None, resid_drift=0.3, min_drift_steps=5, drift_window=20)
+        enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, refit_policy=policy)
+        assert len(policy.refit_idx) > 1 and policy.refit_idx[1] >= 5
+
+    def test_parallel_SPCI_backtest_matches_serial(self, setup_small_enbpi):
+        """Chunked process-pool SPCI backtest stitches back to the serial intervals"""
+        enbpi = setup_small_enbpi
+        enbpi.random_state = 0
+        PIs = []
+        for n_jobs in [1, 2]:
+            enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, stride=2,
+                                              refit_policy=SPCI.utils.QRF_refit_policy(every=3), n_jobs=n_jobs)
+            assert enbpi.refit_policy.refit_idx == list(range(0, 30, 4))
+            PIs.append(enbpi.PIs_Ensemble.to_numpy())
+        np.testing.assert_array_equal(PIs[0], PIs[1])
+
+        # Any executor: the chunks come from num_chunks, not from the executor's internals
+        class CountingExecutor(ThreadPoolExecutor):
+            num_submitted = 0
+
+            def submit(self, *args, **kwargs):
+                self.num_submitted += 1
+                return super().submit(*args, **kwargs)
+
+        with CountingExecutor(max_workers=1) as executor:
+            enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, stride=2,
+                                              refit_policy=SPCI.utils.QRF_refit_policy(every=3), executor=executor,
+                                              num_chunks=3)
+        # 30 test indices in chunks of whole 4-index refit periods
+        assert executor.num_submitted == 3
+        np.testing.assert_array_equal(enbpi.PIs_Ensemble.to_numpy(), PIs[0])
+
+    def test_threaded_multi_horizon_QRF(self, setup_small_enbpi, monkeypatch):
+        """Training the stride-many QRFs in threads gives the serial intervals, read off the fits' own distributions"""
+        enbpi = setup_small_enbpi
+        enbpi.random_state = 0
+        PIs = []
+        for threads in [1, 3]:
+            enbpi.QRF_threads = threads
+            enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, stride=3)
+            PIs.append(enbpi.PIs_Ensemble.to_numpy())
+        np.testing.assert_array_equal(PIs[0], PIs[1])
+        # Each horizon's cached distribution sits at the prediction features and agrees with the forest
+        for rfqr, (feature, leaf_dist) in zip(enbpi.QRF_ls, enbpi.leaf_dist_ls):
+            np.testing.assert_allclose(leaf_dist.quantile(enbpi.quantiles),
+                                       rfqr.predict(feature[None], quantiles=enbpi.quantiles.tolist())[0], atol=1e-12)
+        # By default the horizons share the cores instead of fitting one core each
+        monkeypatch.setattr(SPCI.os, 'cpu_count', lambda: 7)
+        fit_QRF, n_jobs = enbpi.fit_QRF, []
+        monkeypatch.setattr(enbpi, 'fit_QRF', lambda *args, **kwargs: n_jobs.append(kwargs['n_jobs']) or fit_QRF(*args, **kwargs))
+        enbpi.QRF_threads = None
+        enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, stride=3)
+        assert set(n_jobs) == {2}
+
+    @pytest.mark.parametrize("use_SPCI", [False, True])
+    def test_multi_alpha_matches_single_alpha(self, setup_small_enbpi, use_SPCI):
+        """One pass over several alpha gives the intervals of one run per alpha"""
+        enbpi = setup_small_enbpi
+        enbpi.random_state = 0
+        kwargs = dict(smallT=not use_SPCI, past_window=50, use_SPCI=use_SPCI, stride=2)
+        PIs = enbpi.compute_PIs_Ensemble_online([0.05, 0.1, 0.2], **kwargs)
+        assert list(PIs.columns.get_level_values('alpha').unique()) == [0.05, 0.1, 0.2]
+        for alpha in [0.05, 0.1, 0.2]:
+            single = enbpi.compute_PIs_Ensemble_online(alpha, **kwargs)
+            np.testing.assert_array_equal(PIs[alpha].to_numpy(), single.to_numpy())
+
+    def test_batched_QRF_widths_match_per_step(self, setup_small_enbpi):
+        """Widths predicted for a whole segment between refits equal one predict per test index"""
+        enbpi = setup_small_enbpi
+        enbpi.random_state = 0
+        enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, stride=2,
+                                          refit_policy=SPCI.utils.QRF_refit_policy(every=20))
+        features = SPCI.sliding_window_view(enbpi.Ensemble_online_resid[-80:], 50)
+        for k in range(2):
+            batched = enbpi.QRF_widths_batch(k, features)
+            np.testing.assert_array_equal(batched, [enbpi.QRF_widths(k, feature) for feature in features])
+        # With coverage-drift refits, widths are needed step by step; both loops agree
+        PIs = enbpi.PIs_Ensemble.to_numpy()
+        enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, stride=2,
+                                          refit_policy=SPCI.utils.QRF_refit_policy(every=20, coverage_drift=1))
+        np.testing.assert_array_equal(enbpi.PIs_Ensemble.to_numpy(), PIs)
+
+    def test_online_quantile_forest_matches_refilled_leaves(self):
+        """Sliding the online forest equals filling its leaves with the final window directly"""
+        rng = np.random.default_rng(0)
+        X, y = rng.normal(size=(160, 4)), rng.normal(size=160)
+        forest = SPCI.utils.OnlineQuantileForest(n_estimators=5, max_depth=3, random_state=0, decay=0.99)
+        forest.fit(X[:100], y[:100], np.arange(100))
+        for start in range(10, 61, 10):
+            forest.update(X[start:start+100], y[start:start+100], np.arange(start, start+100))
+        assert sorted(forest.samples) == list(range(60, 160))
+        quantiles = np.array([0.05, 0.5, 0.95])
+        leaf_window, leaf_query = forest.forest.apply(X[60:]), forest.forest.apply(X[:3])
+        decay = 0.99 ** (159 - np.arange(60, 160))
+        for r in range(3):
+            weights = sum(decay * (leaf_window[:, t] == leaf_query[r, t]) /
+                          (decay * (leaf_window[:, t] == leaf_query[r, t])).sum() for t in range(5))
+            order = np.argsort(y[60:], kind='stable')
+            cdf = np.cumsum(weights[order])
+            expected = y[60:][order][np.searchsorted(cdf, quantiles * cdf[-1])]
+            np.testing.assert_allclose(forest.predict(X[r], quantiles)[0], expected)
+
+    def test_online_quantile_forest_long_stream(self):
+        """Leaf mixtures equal the pooled leaf distribution, also after the decayed weights were rescaled"""
+        rng = np.random.default_rng(1)
+        X, y = rng.normal(size=(1100, 3)), rng.integers(0, 20, 1100).astype(float)  # with ties
+        decay = SPCI.utils.DecayWeights(0.5)
+        forest = SPCI.utils.OnlineQuantileForest(n_estimators=4, max_depth=2, random_state=0, decay=decay)
+        forest.fit(X[:100], y[:100], np.arange(100))
+        for start in range(1, 1001):
+            forest.update(X[start:start+100], y[start:start+100], np.arange(start, start+100))
+        assert forest.ref > 0 and sorted(forest.samples) == list(range(1000, 1100))
+        # The weights come from the shared table, which stays within a few windows
+        assert forest.decay_weights is decay and len(decay.powers) <= 512
+        quantiles = np.linspace(0, 1, 21)
+        leaf_window, leaf_query = forest.forest.apply(X[1000:]), forest.forest.apply(X[:5])
+        for r in range(5):
+            vals, weights = [], []
+            for t in range(4):
+                in_leaf = leaf_window[:, t] == leaf_query[r, t]
+                if in_leaf.any():
+                    w = 0.5 ** (1099 - np.arange(1000, 1100)[in_leaf])
+                    vals.append(y[1000:][in_leaf])
+                    weights.append(w / w.sum())
+            expected = SPCI.utils.LeafDistribution(np.concatenate(vals), np.concatenate(weights), 'inverted_cdf')
+            np.testing.assert_array_equal(forest.predict(X[r], quantiles)[0], expected.quantile(quantiles))
+
+    @pytest.mark.parametrize("quantile_regr", ['online_RF', 'LR', 'KNN'])
+    def test_incremental_quantile_regr_SPCI(self, setup_small_enbpi, quantile_regr):
+        """SPCI with incrementally updated quantile regressors gives finite, ordered intervals"""
+        enbpi = setup_small_enbpi
+        enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True, quantile_regr=quantile_regr)
+        PIs = enbpi.PIs_Ensemble.to_numpy()
+        assert np.all(np.isfinite(PIs)) and np.all(PIs[:, 0] <= PIs[:, 1])
+        if quantile_regr == 'online_RF':
+            assert isinstance(enbpi.QRF_ls[0], SPCI.utils.OnlineQuantileForest)
+            assert sorted(enbpi.QRF_ls[0].samples)[-1] == 29 + 249
+        elif quantile_regr == 'LR':
+            assert enbpi.QRF_ls[0].ids[-1] == 29 + 249
+        else:
+            assert enbpi.QRF_ls[0].last == 29 + 249
+
+    def test_quantile_regr_defaults_to_attribute(self, setup_small_enbpi):
+        """quantile_regr=None keeps the regressor chosen through the quantile_regr attribute"""
+        enbpi = setup_small_enbpi
+        enbpi.quantile_regr = 'KNN'
+        enbpi.compute_PIs_Ensemble_online(0.1, smallT=False, past_window=50, use_SPCI=True)
+        assert enbpi.quantile_regr == 'KNN'
+        assert isinstance(enbpi.QRF_ls[0], SPCI.utils.KNNQuantileRegressor)
+        predictor = SPCI.SPCI_online_predictor(enbpi, 0.1, past_window=50)
+        predictor.predict_interval()
+        assert isinstance(enbpi.QRF_ls[0], SPCI.utils.KNNQuantileRegressor)
+
+    @pytest.mark.skipif(not SPCI.HAS_QUANTILE_FOREST, reason="needs quantile-forest")
+    def test_leaf_distribution_matches_forest_predict(self):
+        """Cached leaf distribution reproduces quantile-forest predictions on a dense beta grid"""
+        rng = np.random.default_rng(0)
+        X, y = rng.normal(size=(300, 5)), rng.normal(size=300)
+        quantiles = np.r_[np.linspace(0, 0.1, 100), np.linspace(0.9, 1, 100)]
+        for max_samples_leaf in [1, None]:
+            rfqr = SPCI.RandomForestQuantileRegressor(n_estimators=10, max_depth=3, random_state=0,
+                                                      max_samples_leaf=max_samples_leaf).fit(X, y)
+            leaf_dist = SPCI.utils.leaf_distribution(rfqr, y, X[0])
+            np.testing.assert_allclose(leaf_dist.quantile(quantiles),
+                                       rfqr.predict(X[:1], quantiles=quantiles.tolist())[0], atol=1e-12)
+
+    @pytest.mark.skipif(not SPCI.HAS_QUANTILE_FOREST, reason="needs quantile-forest")
+    def test_binning_several_alphas_matches_one_each(self):
+        """One beta search over the union of quantile levels picks each alpha's own beta"""
+        rng = np.random.default_rng(0)
+        X, y = rng.normal(size=(300, 5)), rng.normal(size=300)
+        enbpi = SPCI.SPCI_and_EnbPI(torch.zeros(1, 5), torch.zeros(1, 5), torch.zeros(1), torch.zeros(1))
+        enbpi.alpha = np.array([0.05, 0.1, 0.2])
+        quantiles, quantile_idx = enbpi.QRF_quantiles()
+        rfqr = SPCI.RandomForestQuantileRegressor(n_estimators=10, max_depth=3, random_state=0)
+        i_star, _, wid_left, wid_right = SPCI.utils.binning_use_RF_quantile_regr(
+            rfqr, X[:-1], y[:-1], X[-1], None, quantiles=quantiles, quantile_idx=quantile_idx)
+        for j, alpha in enumerate(enbpi.alpha):
+            beta_ls = np.linspace(0, alpha, enbpi.bins)
+            single = SPCI.utils.binning_use_RF_quantile_regr(
+                rfqr, X[:-1], y[:-1], X[-1], beta_ls, quantiles=np.append(beta_ls, 1 - alpha + beta_ls))
+            assert single == (i_star[j], beta_ls[i_star[j]], wid_left[j], wid_right[j])
+
+    @pytest.mark.parametrize("kind", ['exp_lags', 'summary', 'projection'])
+    def test_residual_featurizer_cache(self, kind):
+        """Cached features of sliding windows equal featurizing each window from scratch"""
+        rng = np.random.default_rng(0)
+        resid = rng.normal(size=400)
+        featurizer = SPCI.utils.ResidualFeaturizer(kind=kind, num_features=8)
+        for i in range(0, 50, 3):
+            features = featurizer.transform(resid[i:i+300], 64, i)
+            fresh = SPCI.utils.ResidualFeaturizer(kind=kind, num_features=8).transform(resid[i:i+300], 64, i)
+            assert features.shape == (237, fresh.shape[1]) and fresh.shape[1] < 64
+            np.testing.assert_allclose(features, fresh, atol=1e-12)
+        window = resid[10:74]
+        if kind == 'summary':
+            np.testing.assert_allclose(featurizer.transform(window, 64, 10)[0, -3:],
+                                       [window.mean(), window.std(), np.abs(window).mean()])
+
+    def test_linear_quantile_regressor_warm_start(self):
+        """Sliding ADMM fits track a cold fit, and the quantile losses are near the exact LP solution"""
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(260, 4))
+        y = X @ rng.normal(size=4) + rng.standard_t(3, size=260)
+        quantiles = np.array([0.05, 0.5, 0.95])
+        warm = SPCI.utils.LinearQuantileRegressor(quantiles, max_iter=50).fit(X[:200], y[:200], np.arange(200))
+        for start in range(5, 61, 5):
+            warm.update(X[start:start+200], y[start:start+200], np.arange(start, start+200))
+        cold = SPCI.utils.LinearQuantileRegressor(quantiles, max_iter_fit=5000, tol=1e-10).fit(X[60:], y[60:])
+        np.testing.assert_allclose(warm.G, np.linalg.inv(cold.X.T @ cold.X + cold.ridge * np.eye(5)), atol=1e-10)
+        r_warm, r_cold = y[60:, None] - warm.predict(X[60:]), y[60:, None] - cold.predict(X[60:])
+        loss = lambda r: np.maximum(quantiles * r, (quantiles - 1) * r).mean(0)
+        np.testing.assert_allclose(loss(r_warm), loss(r_cold), rtol=5e-3)
+        np.testing.assert_array_equal(warm.predict(X[:2], [0.95, 0.05]), warm.predict(X[:2])[:, [2, 0]])
+
+    def test_knn_quantile_regressor_matches_brute_force(self):
+        """The ring-buffer index returns the quantiles of the k nearest lag vectors of the current window"""
+        rng = np.random.default_rng(0)
+        X, y = rng.normal(size=(150, 6)), rng.normal(size=150)
+        knn = SPCI.utils.KNNQuantileRegressor([0.1, 0.5, 0.9], n_neighbors=15).fit(X[:80], y[:80], np.arange(80))
+        for start in range(7, 71, 7):
+            knn.update(X[start:start+80], y[start:start+80], np.arange(start, start+80))
+        query = rng.normal(size=6)
+        nn = np.argsort(((X[70:] - query)**2).sum(1))[:15]
+        np.testing.assert_allclose(knn.predict(query)[0], np.quantile(y[70:][nn], [0.1, 0.5, 0.9], method='inverted_cdf'))
+        # Unit decay weights read the same quantiles as the unweighted regressor
+        flat = SPCI.utils.KNNQuantileRegressor([0.1, 0.5, 0.9], n_neighbors=15, decay=1.0).fit(X[70:150], y[70:150], np.arange(70, 150))
+        np.testing.assert_array_equal(flat.predict(query), knn.predict(query))
+
+    def test_decay_weights_table(self):
+        """Windows and ages read the shared table and equal the direct powers"""
+        weights = SPCI.utils.DecayWeights(0.99)
+        first = weights.window(50, newest_age=1)
+        np.testing.assert_array_equal(first, 0.99 ** np.arange(50, 0, -1))
+        assert np.shares_memory(first, weights.powers)
+        ids = np.array([3, 40, 250, 299])
+        np.testing.assert_array_equal(weights.ages(299 - ids), 0.99 ** (299 - ids).astype(float))
+        # Growing the table leaves earlier windows valid and later ones views again
+        np.testing.assert_array_equal(first, 0.99 ** np.arange(50, 0, -1))
+        assert np.shares_memory(weights.window(300), weights.powers)